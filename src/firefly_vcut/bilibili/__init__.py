@@ -1,11 +1,13 @@
 from . import wbi
 from . import video
+from . import video_async
 from . import series
 from . import buvid3
 
 __all__ = [
     "wbi",
     "video",
+    "video_async",
     "series",
     "buvid3",
 ]
\ No newline at end of file
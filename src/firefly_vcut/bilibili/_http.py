@@ -0,0 +1,95 @@
+"""
+Shared HTTP session for bilibili API calls.
+
+All the bilibili endpoints live on a handful of hosts, so we keep one session around
+and let urllib3 reuse keep-alive connections instead of doing a TCP + TLS handshake
+for every request.
+"""
+
+from itertools import takewhile
+import json
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..config import BILIBILI_RETRY_CONFIG
+
+
+class _ConfiguredRetry(Retry):
+    """
+    A Retry that waits on the schedule of BILIBILI_RETRY_CONFIG rather than urllib3's
+    own, which ignores the exponent and doesn't wait at all before the first retry.
+    """
+
+    def get_backoff_time(self) -> float:
+        # The history already holds the error being retried, so this is the retry's number
+        consecutive_errors = len(
+            list(takewhile(lambda x: x.redirect_location is None, reversed(self.history)))
+        )
+        if consecutive_errors == 0:
+            return 0
+        config = BILIBILI_RETRY_CONFIG
+        # Jittered like retry._Backoff, so that requests failing together don't retry
+        # in lockstep
+        delay = random.uniform(
+            config.initial_backoff,
+            config.initial_backoff * config.exponent ** consecutive_errors,
+        )
+        if config.max_backoff is not None:
+            delay = min(delay, config.max_backoff)
+        return delay
+
+
+# Statuses worth retrying: rate limiting and server errors. Anything else is a problem
+# with the request itself.
+RETRY_STATUS_CODES = frozenset({429, *BILIBILI_RETRY_CONFIG.retry_on_status_codes})
+
+# Retries happen inside the connection pool, so a request backing off doesn't hold up
+# the other requests in flight on the session, and 429s wait out their Retry-After.
+# Exhausted status retries hand back the last response for the caller to report.
+RETRIES = _ConfiguredRetry(
+    total=BILIBILI_RETRY_CONFIG.max_retries,
+    status_forcelist=RETRY_STATUS_CODES,
+    allowed_methods=["GET"],
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+SESSION = requests.Session()
+SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=RETRIES)
+)
+
+# (connect, read) timeout in seconds. Without one a stalled bilibili endpoint hangs the
+# caller forever, with one it surfaces as an exception the session retries.
+DEFAULT_TIMEOUT = (3.05, 10)
+
+WEB_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
+DROID_USER_AGENT = "Mozilla/5.0 BiliDroid/6.73.1 (bbcallen@gmail.com) os/android model/Mi 10 Pro mobi_app/android build/6731100 channel/xiaomi innerVer/6731110 osVer/12 network/2"
+
+# Headers for endpoints that don't need a login.
+DROID_HEADERS = {"User-Agent": DROID_USER_AGENT}
+
+
+def web_headers(sessdata: str) -> dict:
+    """
+    Headers for endpoints called on behalf of the login user.
+    """
+    return {
+        "User-Agent": WEB_USER_AGENT,
+        "Cookie": f"SESSDATA={sessdata}",
+    }
+
+
+def decode_json(content: bytes):
+    """
+    Decode a JSON response body.
+
+    json.loads takes the raw bytes and decodes them as UTF-8 itself. Going through
+    requests' Response.text (or Response.json() on a response without a charset) would
+    instead guess the encoding by running charset detection over the whole body, and
+    the series pages in particular are several MB.
+    """
+    return json.loads(content)
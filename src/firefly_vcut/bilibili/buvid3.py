@@ -1,20 +1,19 @@
-import requests
+from ._http import SESSION, DEFAULT_TIMEOUT, web_headers, decode_json
 
 def get_buvid3(sessdata: str) -> str:
     base_url = "https://api.bilibili.com/x/frontend/finger/spi"
+    headers = web_headers(sessdata)
 
-    resp = requests.get(
+    resp = SESSION.get(
         base_url,
-        headers={
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
-            "Cookie": f"SESSDATA={sessdata}",
-        },
+        headers=headers,
+        timeout=DEFAULT_TIMEOUT,
     )
 
     if resp.status_code != 200:
         raise Exception(f"Failed to get buvid3: {resp.status_code}, Body: {resp.text}")
 
-    data = resp.json()
+    data = decode_json(resp.content)
     if data["code"] != 0:
         raise Exception(f"Failed to get buvid3: {data['code']}, {data['message']}")
 
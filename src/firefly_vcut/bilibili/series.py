@@ -1,6 +1,47 @@
-import requests
-from ..retry import retry_with_backoff
-from ..config import BILIBILI_RETRY_CONFIG
+from ._http import SESSION, DEFAULT_TIMEOUT, DROID_HEADERS, decode_json
+
+
+def _fetch_seasons_series_raw(mid: int) -> dict:
+    """
+    Fetch the seasons and series of a given user, returning the parsed response.
+    """
+    URL = "https://api.bilibili.com/x/polymer/web-space/home/seasons_series"
+
+    # You're not going to have 10000 series, are you?
+    response = SESSION.get(
+        URL,
+        params={"mid": mid, "page_num": 1000, "page_size": 10},
+        headers=DROID_HEADERS,
+        timeout=DEFAULT_TIMEOUT,
+    )
+    response.raise_for_status()
+    return decode_json(response.content)
+
+
+def _fetch_series_archives_raw(mid: int, series_id: int, pn: int, page_size: int) -> dict:
+    """
+    Fetch one page of archives of a given series, newest first, returning the parsed
+    response.
+    """
+    URL = "https://api.bilibili.com/x/series/archives"
+
+    params = {
+        "mid": mid,
+        "series_id": series_id,
+        "pn": pn,
+        "ps": page_size,
+        "sort": "desc",
+    }
+
+    response = SESSION.get(
+        URL,
+        params=params,
+        headers=DROID_HEADERS,
+        timeout=DEFAULT_TIMEOUT,
+    )
+    response.raise_for_status()
+    return decode_json(response.content)
+
 
 def get_live_recording_series(mid: int) -> dict | None:
     """
@@ -15,23 +56,7 @@ def get_live_recording_series(mid: int) -> dict | None:
         - series_id: The series ID.
         - name: The name of the series.
     """
-    URL = "https://api.bilibili.com/x/polymer/web-space/home/seasons_series"
-
-    # You're not going to have 10000 series, are you?
-    def _make_request():
-        response = requests.get(
-            URL,
-            params={"mid": mid, "page_num": 1000, "page_size": 10},
-            headers={
-                "User-Agent": "Mozilla/5.0 BiliDroid/6.73.1 (bbcallen@gmail.com) os/android model/Mi 10 Pro mobi_app/android build/6731100 channel/xiaomi innerVer/6731110 osVer/12 network/2",
-            },
-        )
-        return response
-
-    response = retry_with_backoff(_make_request, BILIBILI_RETRY_CONFIG)
-    response.raise_for_status()
-
-    series_list = response.json()["data"]["items_lists"]["series_list"]
+    series_list = _fetch_seasons_series_raw(mid)["data"]["items_lists"]["series_list"]
 
     for series in series_list:
         meta = series["meta"]
@@ -62,8 +87,6 @@ def get_archives_from_series(
         limit: The limit of the number of archives to get.
     """
 
-    URL = "https://api.bilibili.com/x/series/archives"
-
     archives = []
 
     # fetch 5000 in a row, so probably we get all of them in one request.
@@ -71,28 +94,14 @@ def get_archives_from_series(
     # at the entire archive series to find the ones we wanted to add.
     pn = 1
     page_size = 5000
+    # An archive is only filtered out when it falls within both bounds, so without
+    # both of them every archive matches and the first `limit` ones are all we keep.
+    # Don't download and parse a 5000-archive page just to take a handful off the top.
+    if pubdate_after is None or pubdate_before is None:
+        page_size = limit
 
     while len(archives) < limit:
-        params = {
-            "mid": mid,
-            "series_id": series_id,
-            "pn": pn,
-            "ps": page_size,
-        }
-
-        def _make_request():
-            response = requests.get(
-                URL,
-                params=params,
-                headers={
-                    "User-Agent": "Mozilla/5.0 BiliDroid/6.73.1 (bbcallen@gmail.com) os/android model/Mi 10 Pro mobi_app/android build/6731100 channel/xiaomi innerVer/6731110 osVer/12 network/2",
-                },
-            )
-            return response
-
-        response = retry_with_backoff(_make_request, BILIBILI_RETRY_CONFIG)
-        response.raise_for_status()
-        response = response.json()
+        response = _fetch_series_archives_raw(mid, series_id, pn, page_size)
 
         if response["code"] != 0:
             raise ValueError(f"Failed to get archives from series: {response}")
@@ -107,7 +116,7 @@ def get_archives_from_series(
             archives.append(archive)
             if len(archives) >= limit:
                 break
-        
+
         # This is the last page
         if len(response["data"]["archives"]) < page_size:
             break
@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import urllib.parse
+from collections.abc import AsyncIterator
+
+import aiohttp
+
+from . import video
+from . import wbi
+from ._http import DEFAULT_TIMEOUT, RETRY_STATUS_CODES, web_headers, decode_json
+from ..retry import NonRetryableError, retry_with_backoff_async
+from ..config import BILIBILI_RETRY_CONFIG
+
+# Cap the number of in-flight requests to bilibili so that fanning out over many
+# bvids doesn't get us rate limited.
+MAX_CONCURRENT_REQUESTS = 8
+
+
+def create_client_session() -> aiohttp.ClientSession:
+    """
+    Create an aiohttp session suitable for fanning out bilibili API calls.
+
+    The connector keeps connections to api.bilibili.com alive so that concurrent
+    requests share a small pool instead of handshaking for every call. Connections
+    per host are capped at the request concurrency: any more would only ever be
+    opened and left idle.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=20,
+            limit_per_host=MAX_CONCURRENT_REQUESTS,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        ),
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=DEFAULT_TIMEOUT[0], sock_read=DEFAULT_TIMEOUT[1]
+        ),
+    )
+
+
+async def _raise_for_status(resp: aiohttp.ClientResponse, action: str):
+    """
+    Raise for a response that isn't a 200. Only the statuses the sync session retries
+    on are retried by retry_with_backoff_async, the rest won't go away on their own.
+    """
+    if resp.status == 200:
+        return
+    body = await resp.text()
+    message = f"Failed to {action}: {resp.status}, Body: {body}"
+    if resp.status in RETRY_STATUS_CODES:
+        raise Exception(message)
+    raise NonRetryableError(message)
+
+
+async def iter_user_videos(
+    session: aiohttp.ClientSession,
+    mid: int,
+    sessdata: str,
+    wbi_key: tuple[str, str],
+    pubdate_after: int,
+) -> AsyncIterator[dict]:
+    """
+    Iterate over the uploaded videos of a given user published after a given pubdate,
+    newest first.
+
+    Videos are yielded as soon as their page is parsed, so the caller can start working
+    on them (e.g., fetching their info) while we wait out the rate limit between pages.
+    The pause between pages is an asyncio sleep, so other requests issued on the
+    same event loop keep making progress.
+
+    Args:
+        session: The aiohttp session to issue the requests with.
+        mid: The Bilibili user ID.
+        sessdata: The sessdata of the login user.
+        wbi_key: The wbi key of the login user.
+        pubdate_after: The publication date after which to list videos.
+
+    Yields:
+        A dict of the bvid, title and pubdate ("created") of each video.
+    """
+
+    # See comments in https://github.com/SocialSisterYi/bilibili-API-collect/blob/e5fbfed42807605115c6a9b96447f6328ca263c5/docs/user/space.md
+    # Don't bother with https://api.bilibili.com/x/space/wbi/arc/search
+    base_url = "https://api.bilibili.com/x/series/recArchivesByKeywords"
+    headers = web_headers(sessdata)
+    img_key, sub_key = wbi_key
+
+    pn = 1
+    while True:
+        print(f"Listing user {mid} videos, page {pn}")
+
+        params = {
+            "mid": mid,
+            "keywords": "",
+            "orderby": "pubdate",
+            "type": 0,  # 不筛选分区
+            "ps": 30,
+            "pn": pn,
+        }
+        encoded_params = wbi.encWbi(params=params, img_key=img_key, sub_key=sub_key)
+        # Encode the signed query once, retries resend the same URL.
+        url = f"{base_url}?{urllib.parse.urlencode(encoded_params)}"
+
+        async def _make_request():
+            async with session.get(
+                url,
+                headers=headers,
+            ) as resp:
+                await _raise_for_status(resp, "list user videos")
+                return decode_json(await resp.read())
+
+        data = await retry_with_backoff_async(_make_request, BILIBILI_RETRY_CONFIG)
+        if data["code"] != 0:
+            raise Exception(
+                f"Failed to list user videos: {data['code']}, {data['message']}"
+            )
+
+        archives = data["data"]["archives"]
+        # Ran out of videos before reaching pubdate_after
+        if not archives:
+            return
+
+        for video in archives:
+            pubdate = video["pubdate"]
+            if pubdate <= pubdate_after:
+                return
+            yield {
+                "bvid": video["bvid"],
+                "title": video["title"],
+                "created": pubdate,
+            }
+
+        # A short page is the last one, don't wait out the rate limit just to get
+        # an empty page back
+        if len(archives) < params["ps"]:
+            return
+
+        # Sleep for 1.5 seconds to avoid rate limiting, without blocking the event loop
+        await asyncio.sleep(1.5)
+        pn += 1
+
+
+async def get_video_info_async(
+    session: aiohttp.ClientSession,
+    bvid: str,
+    sessdata: str,
+) -> dict:
+    """
+    Get video info from Bilibili. Async version of video.get_video_info, sharing
+    the same cache.
+
+    Args:
+        session: The aiohttp session to issue the request with.
+        bvid: The Bilibili video ID.
+        sessdata: The sessdata of the login user.
+    """
+    info = video.cached_video_info(bvid, sessdata)
+    if info is not None:
+        return info
+
+    headers = web_headers(sessdata)
+
+    async def _make_request():
+        async with session.get(
+            "https://api.bilibili.com/x/web-interface/view",
+            params={
+                "bvid": bvid,
+            },
+            headers=headers,
+        ) as resp:
+            await _raise_for_status(resp, "get video info")
+            return decode_json(await resp.read())
+
+    info = await retry_with_backoff_async(_make_request, BILIBILI_RETRY_CONFIG)
+    video.cache_video_info(bvid, sessdata, info)
+    return info
+
+
+async def get_video_stream_url_async(
+    session: aiohttp.ClientSession,
+    bvid: str,
+    cid: int,
+    fnval: int,
+    sessdata: str,
+    wbi_key: tuple[str, str],
+) -> dict:
+    """
+    Get the stream url info for a video. Async version of video.get_video_stream_url.
+
+    Args:
+        session: The aiohttp session to issue the request with.
+        bvid: The Bilibili video ID.
+        cid: The cid of the video.
+        fnval: The fnval of the video.
+        sessdata: The sessdata of the login user.
+        wbi_key: The wbi key of the login user.
+    """
+
+    base_url = "https://api.bilibili.com/x/player/wbi/playurl"
+
+    params = {
+        "bvid": bvid,
+        "cid": str(cid),
+        "fnval": str(fnval),
+    }
+
+    img_key, sub_key = wbi_key
+    encoded_params = wbi.encWbi(params=params, img_key=img_key, sub_key=sub_key)
+    # Encode the signed query once, retries resend the same URL.
+    url = f"{base_url}?{urllib.parse.urlencode(encoded_params)}"
+    headers = web_headers(sessdata)
+
+    async def _make_request():
+        async with session.get(
+            url,
+            headers=headers,
+        ) as resp:
+            await _raise_for_status(resp, "get video stream url")
+            return decode_json(await resp.read())
+
+    return await retry_with_backoff_async(_make_request, BILIBILI_RETRY_CONFIG)
+
+
+async def batch_get_video_infos(
+    bvids: list[str],
+    sessdata: str,
+    session: aiohttp.ClientSession | None = None,
+) -> dict[str, dict | BaseException]:
+    """
+    Get the video info of many videos concurrently.
+
+    Args:
+        bvids: The Bilibili video IDs.
+        sessdata: The sessdata of the login user.
+        session: The aiohttp session to issue the requests with, a session of our own
+            (see create_client_session) is opened and closed if not given.
+
+    Returns:
+        A dictionary mapping each bvid to its video info response, or to the exception
+        raised while fetching it so that one bad video doesn't fail the whole batch.
+    """
+    infos: dict[str, dict | BaseException] = {}
+    # Each bvid is only looked up once, and known videos never reach the network.
+    missing = []
+    for bvid in dict.fromkeys(bvids):
+        info = video.cached_video_info(bvid, sessdata)
+        if info is None:
+            missing.append(bvid)
+        else:
+            infos[bvid] = info
+
+    if not missing:
+        return infos
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    if session is None:
+        session_context = create_client_session()
+    else:
+        session_context = contextlib.nullcontext(session)
+
+    async with session_context as session:
+
+        async def _get(bvid: str) -> dict:
+            async with semaphore:
+                return await get_video_info_async(session, bvid, sessdata)
+
+        fetched = await asyncio.gather(
+            *[_get(bvid) for bvid in missing], return_exceptions=True
+        )
+
+    infos.update(zip(missing, fetched))
+    return infos
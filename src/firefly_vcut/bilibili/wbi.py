@@ -1,10 +1,8 @@
-from functools import reduce
+from functools import reduce, lru_cache
 from hashlib import md5
 import urllib.parse
 import time
-import requests
-from ..config import BILIBILI_RETRY_CONFIG
-from ..retry import retry_with_backoff
+from ._http import SESSION, DEFAULT_TIMEOUT, decode_json
 
 mixinKeyEncTab = [
     46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49,
@@ -13,6 +11,11 @@ mixinKeyEncTab = [
     36, 20, 34, 44, 52
 ]
 
+# 过滤 value 中的 "!'()*" 字符
+_filterTable = str.maketrans('', '', "!'()*")
+
+# 同一组 key 在分页时会被反复使用, 缓存打乱结果
+@lru_cache(maxsize=8)
 def getMixinKey(orig: str):
     '对 imgKey 和 subKey 进行字符顺序打乱编码'
     return reduce(lambda s, i: s + orig[i], mixinKeyEncTab, '')[:32]
@@ -25,7 +28,7 @@ def encWbi(params: dict, img_key: str, sub_key: str):
     params = dict(sorted(params.items()))                       # 按照 key 重排参数
     # 过滤 value 中的 "!'()*" 字符
     params = {
-        k : ''.join(filter(lambda chr: chr not in "!'()*", str(v)))
+        k : str(v).translate(_filterTable)
         for k, v 
         in params.items()
     }
@@ -42,13 +45,9 @@ def getWbiKeys(sessdata: str) -> tuple[str, str]:
         'Cookie': f'SESSDATA={sessdata}',
     }
     
-    def _make_request():
-        resp = requests.get('https://api.bilibili.com/x/web-interface/nav', headers=headers)
-        return resp
-    
-    resp = retry_with_backoff(_make_request, BILIBILI_RETRY_CONFIG)
+    resp = SESSION.get('https://api.bilibili.com/x/web-interface/nav', headers=headers, timeout=DEFAULT_TIMEOUT)
     resp.raise_for_status()
-    json_content = resp.json()
+    json_content = decode_json(resp.content)
     img_url: str = json_content['data']['wbi_img']['img_url']
     sub_url: str = json_content['data']['wbi_img']['sub_url']
     img_key = img_url.rsplit('/', 1)[1].split('.')[0]
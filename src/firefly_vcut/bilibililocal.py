@@ -1,11 +1,18 @@
 import logging
-import requests
-from .retry import retry_with_backoff, BILIBILI_RETRY_CONFIG
+import operator
+from concurrent.futures import ThreadPoolExecutor
+from .bilibili import series as bilibili_series
 
 from .types import Archive, Series
 
 logger = logging.getLogger(__name__)
 
+# Number of series pages to fetch in parallel once we know there is more than one page.
+PREFETCH_PAGES = 4
+
+# Fields of a series archive in the positional order of Archive, after id.
+_archive_fields = operator.itemgetter("bvid", "title", "pubdate", "pic", "duration")
+
 
 def get_live_recording_series(mid: int) -> Series | None:
     """
@@ -17,31 +24,10 @@ def get_live_recording_series(mid: int) -> Series | None:
     Returns:
         Series: The live recording series of the user
     """
-    URL = "https://api.bilibili.com/x/polymer/web-space/home/seasons_series"
-
-    def _make_request():
-        response = requests.get(
-            URL,
-            params={"mid": mid, "page_num": 1000, "page_size": 10},
-            headers={
-                "User-Agent": "Mozilla/5.0 BiliDroid/6.73.1 (bbcallen@gmail.com) os/android model/Mi 10 Pro mobi_app/android build/6731100 channel/xiaomi innerVer/6731110 osVer/12 network/2"
-            },
-        )
-        return response
-
-    response = retry_with_backoff(_make_request, BILIBILI_RETRY_CONFIG)
-    response.raise_for_status()
-
-    series_list = response.json()["data"]["items_lists"]["series_list"]
-
-    for series in series_list:
-        meta = series["meta"]
-        if meta["name"] == "直播回放":
-            return Series(
-                series_id=meta["series_id"],
-                name=meta["name"],
-            )
-    return None
+    series = bilibili_series.get_live_recording_series(mid)
+    if series is None:
+        return None
+    return Series(series_id=series["series_id"], name=series["name"])
 
 
 def get_archives_from_series(
@@ -58,51 +44,48 @@ def get_archives_from_series(
     Returns:
         list[Archive]: The recordings from the series
     """
-    URL = "https://api.bilibili.com/x/series/archives"
-
     recordings = []
     pn = 1
-
-    while True:
-        params = {
-            "mid": mid,
-            "series_id": series_id,
-            "pn": pn,
-            "ps": page_size,
-        }
-        
-        def _make_request():
-            response = requests.get(
-                URL,
-                params=params,
-                headers={
-                    "User-Agent": "Mozilla/5.0 BiliDroid/6.73.1 (bbcallen@gmail.com) os/android model/Mi 10 Pro mobi_app/android build/6731100 channel/xiaomi innerVer/6731110 osVer/12 network/2",
-                },
-            )
-            return response
-            
-        response = retry_with_backoff(_make_request, BILIBILI_RETRY_CONFIG)
-        response.raise_for_status()
-        response = response.json()
-
-        if response["code"] != 0:
-            logger.error(f"获取回放视频失败: {response}")
-            break
-
-        recordings.extend([
-            Archive(
-                id=None,
-                bvid=archive["bvid"],
-                title=archive["title"],
-                pubdate=archive["pubdate"],
-                cover=archive["pic"],
-                duration=archive["duration"],
-            )
-            for archive in response["data"]["archives"]
-        ])
-
-        if len(response["data"]["archives"]) < page_size:
-            break
-        pn += 1
+    # The first page is usually all there is, so only fetch it alone. If it turns out
+    # to be full, speculatively fetch the following pages in parallel.
+    batch_size = 1
+
+    with ThreadPoolExecutor(max_workers=PREFETCH_PAGES) as executor:
+        done = False
+        while not done:
+            futures = [
+                executor.submit(
+                    bilibili_series._fetch_series_archives_raw,
+                    mid,
+                    series_id,
+                    pn + i,
+                    page_size,
+                )
+                for i in range(batch_size)
+            ]
+
+            for future in futures:
+                response = future.result()
+
+                if response["code"] != 0:
+                    logger.error(f"获取回放视频失败: {response}")
+                    done = True
+                    break
+
+                recordings.extend(
+                    Archive(None, *_archive_fields(archive))
+                    for archive in response["data"]["archives"]
+                )
+
+                # This is the last page, the remaining speculative pages are empty
+                if len(response["data"]["archives"]) < page_size:
+                    done = True
+                    break
+
+            for future in futures:
+                future.cancel()
+
+            pn += batch_size
+            batch_size = PREFETCH_PAGES
 
     return recordings
\ No newline at end of file
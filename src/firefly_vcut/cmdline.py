@@ -7,29 +7,48 @@ import pytz
 import whisper
 import tqdm
 import boto3
-import botocore
 import click
+import queue
 import sys
-
-from .fuzz import search_text_in_transcript
+import threading
+from collections.abc import Iterator
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+
+from .fuzz import (
+    find_exact_text_in_transcript,
+    preprocess_transcript,
+    search_many_preprocessed,
+    search_text_in_transcript,
+)
 from .dblocal import (
-    get_all_archives_from_db,
-    get_all_occurrences_from_db,
     get_all_vtuber_songs_from_db,
     get_archives_by_bvid,
     get_db_connection,
+    get_existing_bvids,
     get_latest_archives_from_db,
+    get_occurrence_keys,
     get_vtuber_song_by_title,
     insert_archives_to_db,
     insert_song_occurrences_to_db,
+    iter_all_archives_from_db,
+    iter_all_occurrences_from_db,
     update_recording_transcript_and_mark_scanned,
 )
 from .bilibililocal import get_live_recording_series, get_archives_from_series
 from .types import Archive, SongOccurrence
-from .transcribe import download_and_transcribe
+from .transcribe import download, transcribe
 
 logger = logging.getLogger(__name__)
 
+# Number of transcripts to upload to r2 concurrently.
+UPLOAD_WORKERS = 16
+
+SHANGHAI_TZ = pytz.timezone("Asia/Shanghai")
+
+# Number of downloaded archives waiting to be transcribed by the transcriber command.
+DOWNLOAD_AHEAD = 2
+
 
 @click.group()
 @click.option(
@@ -47,6 +66,10 @@ def vcut(ctx: click.Context, root: str, verbose: int):
     ctx.ensure_object(dict)
     ctx.obj["root"] = root
 
+    # Logging is already configured when vcut is invoked more than once in a process
+    if logging.getLogger().handlers:
+        return
+
     match verbose:
         case 0:
             logging.basicConfig(level=logging.ERROR)
@@ -72,44 +95,46 @@ def upload_transcripts_to_r2(ctx: click.Context):
         aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
     )
 
+    bucket = os.getenv("R2_BUCKET")
+    # One listing request per 1000 objects instead of a HEAD request per transcript.
+    existing = _list_object_keys(r2, bucket, "transcripts/")
+
+    # (transcript file, object key) of the transcripts missing from r2
+    uploads = []
     updates = []
-    for mid in os.listdir(root):
-        for year in os.listdir(f"{root}/{mid}"):
-            for month in os.listdir(f"{root}/{mid}/{year}"):
-                for recording_dir_name in os.listdir(f"{root}/{mid}/{year}/{month}"):
-                    meta_file = f"{root}/{mid}/{year}/{month}/{recording_dir_name}/meta.json"
-                    transcript_file = f"{root}/{mid}/{year}/{month}/{recording_dir_name}/segments.json"
-
-                    if not os.path.exists(meta_file) or not os.path.exists(transcript_file):
-                        continue
-                    
-                    with open(meta_file, "r") as f:
-                        meta = json.load(f)
-                    
-                    tkey = transcript_key(mid, meta)
-
-                    try:
-                        r2.head_object(
-                            Bucket=os.getenv("R2_BUCKET"),
-                            Key=tkey,
-                        )
-                    except botocore.exceptions.ClientError as e:
-                        if e.response["Error"]["Code"] == "404":
-                            r2.upload_file(
-                                transcript_file,
-                                os.getenv("R2_BUCKET"),
-                                tkey,
-                            )
-                            print(f"Uploaded {tkey} to r2")
-                        else:
-                            raise e
-                    else:
-                        print(f"Object {tkey} already exists in r2, skipping")
-
-                    updates.append({
-                        "bvid": meta["bvid"],
-                        "transcript_object_key": tkey,
-                    })
+    for mid, _, _, _, recording_dir in _scan_recordings(root):
+        meta_file = f"{recording_dir}/meta.json"
+        transcript_file = f"{recording_dir}/segments.json"
+
+        if not os.path.exists(meta_file) or not os.path.exists(transcript_file):
+            continue
+        
+        meta = _read_json(meta_file)
+        
+        tkey = transcript_key(mid, meta)
+
+        if tkey in existing:
+            print(f"Object {tkey} already exists in r2, skipping")
+        else:
+            uploads.append((transcript_file, tkey))
+
+        updates.append({
+            "bvid": meta["bvid"],
+            "transcript_object_key": tkey,
+        })
+
+    def _upload(upload: tuple[str, str]):
+        transcript_file, tkey = upload
+        r2.upload_file(
+            transcript_file,
+            bucket,
+            tkey,
+        )
+        print(f"Uploaded {tkey} to r2")
+
+    # Uploads are network bound, boto3 clients are safe to share between threads.
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        list(executor.map(_upload, uploads))
 
     with get_db_connection(os.getenv("DATABASE_URL")) as conn:
         update_recording_transcript_and_mark_scanned(conn, updates)
@@ -153,21 +178,20 @@ def sync_archives(ctx: click.Context, mid: int, db_url: str | None):
         )
         sys.exit(1)
 
-    archives_local = get_all_archives_local(root, mid)
-    click.echo(f"从本地存储中获取到 {len(archives_local)} 个直播回放档案")
-
     with get_db_connection(db_url) as conn:
-        archives = get_all_archives_from_db(conn, mid)
+        existing_bvids = get_existing_bvids(conn, mid)
 
-        click.echo(f"从数据库中获取到 {len(archives)} 个直播回放档案")
+        click.echo(f"从数据库中获取到 {len(existing_bvids)} 个直播回放档案")
 
-        archive_bvid_set = set([archive.bvid for archive in archives])
+        # Only the archives missing from the database are kept in memory.
+        local_count = 0
+        archives_to_insert = []
+        for archive in iter_all_archives_local(root, mid):
+            local_count += 1
+            if archive.bvid not in existing_bvids:
+                archives_to_insert.append(archive)
 
-        archives_to_insert = [
-            archive
-            for archive in archives_local
-            if archive.bvid not in archive_bvid_set
-        ]
+        click.echo(f"从本地存储中获取到 {local_count} 个直播回放档案")
         click.echo(f"需要插入 {len(archives_to_insert)} 个直播回放档案")
 
         if not archives_to_insert:
@@ -272,6 +296,7 @@ def sync_occurrences(
     # A hash set of (song_id, archive_id)  where the occurrence exists in the database
     occurrence_set = set()
 
+    # One connection for the reads and every insert batch below.
     with get_db_connection(db_url) as conn:
         if song is not None:
             vtuber_songs = get_vtuber_song_by_title(conn, song, mid)
@@ -284,29 +309,45 @@ def sync_occurrences(
         elif latest is not None:
             archives = get_latest_archives_from_db(conn, mid, latest)
         else:
-            archives = get_all_archives_from_db(conn, mid)
+            # Streamed while matching rather than loaded up front. Pull the first one
+            # so an empty result is still reported below.
+            archive_stream = iter_all_archives_from_db(conn, mid)
+            first_archive = next(archive_stream, None)
+            archives = [] if first_archive is None else chain([first_archive], archive_stream)
 
         if not force_update:
-            occurrences = get_all_occurrences_from_db(conn, mid)
-            occurrence_set = set(
-                [
+            if isinstance(archives, list):
+                # Only the occurrences between the songs and archives we are about to search
+                occurrence_set = get_occurrence_keys(
+                    conn,
+                    [song.vtuber_song_id for song in vtuber_songs],
+                    [archive.id for archive in archives],
+                )
+            else:
+                # Every archive of the user is searched, so are all of their occurrences
+                occurrence_set = {
                     (occurrence.vtuber_song_id, occurrence.archive_id)
-                    for occurrence in occurrences
-                ]
-            )
+                    for occurrence in iter_all_occurrences_from_db(conn, mid)
+                }
 
-    if not vtuber_songs:
-        click.echo("没有找到歌曲", err=True)
-        sys.exit(1)
+        # End the read transaction, the matching below can take a while and the
+        # connection shouldn't sit idle in a transaction meanwhile.
+        conn.commit()
 
-    if not archives:
-        click.echo("没有找到直播回放", err=True)
-        sys.exit(1)
+        if not vtuber_songs:
+            click.echo("没有找到歌曲", err=True)
+            sys.exit(1)
+
+        if not archives:
+            click.echo("没有找到直播回放", err=True)
+            sys.exit(1)
+
+        # Walk the data directory once instead of once per archive.
+        transcripts = _index_transcripts(root)
 
-    with get_db_connection(db_url) as conn:
         new_occurrences = []
         for archive in archives:
-            transcript = find_transcript_from_bvid(root, archive.bvid)
+            transcript = _load_transcript(transcripts.get(archive.bvid))
             if transcript is None:
                 logger.debug(f"没有找到 {archive.bvid} 的转写结果, 跳过")
                 continue
@@ -314,12 +355,32 @@ def sync_occurrences(
             if len(transcript) == 0:
                 raise ValueError(f"没有找到 {archive.bvid} 的转写结果")
 
+            # Shared by the searches for every song below
+            preprocessed = preprocess_transcript(transcript)
+
+            songs = []
             for song in vtuber_songs:
                 if (song.vtuber_song_id, archive.id) in occurrence_set:
                     logger.debug(f"已存在 {song.title} 在 {archive.bvid} 的记录, 跳过")
                     continue
+                songs.append(song)
+
+            # Exact matches are common and much cheaper to find than fuzzy ones.
+            results = [
+                find_exact_text_in_transcript(preprocessed, song.lyrics_fragment)
+                for song in songs
+            ]
+            # Fuzzy search the rest of the songs in one batch
+            misses = [i for i, result in enumerate(results) if result is None]
+            fuzzy_results = search_many_preprocessed(
+                preprocessed,
+                [songs[i].lyrics_fragment for i in misses],
+                score_cutoff=threshold,
+            )
+            for i, result in zip(misses, fuzzy_results):
+                results[i] = result
 
-                result = search_text_in_transcript(transcript, song.lyrics_fragment)
+            for song, result in zip(songs, results):
                 if result is None:
                     logger.debug(
                         f"没有找到 {song.title} 在 {archive.bvid} 的记录, 跳过"
@@ -351,8 +412,7 @@ def sync_occurrences(
 
                 if len(new_occurrences) > 100 and not dry_run:
                     click.echo(f"需要插入 {len(new_occurrences)} 个歌曲出现记录")
-                    with get_db_connection(db_url) as conn:
-                        insert_song_occurrences_to_db(conn, new_occurrences)
+                    insert_song_occurrences_to_db(conn, new_occurrences)
                     click.echo(f"插入 {len(new_occurrences)} 个歌曲出现记录完成")
                     new_occurrences = []
 
@@ -361,8 +421,7 @@ def sync_occurrences(
 
         click.echo(f"需要插入 {len(new_occurrences)} 个歌曲出现记录")
 
-        with get_db_connection(db_url) as conn:
-            insert_song_occurrences_to_db(conn, new_occurrences)
+        insert_song_occurrences_to_db(conn, new_occurrences)
 
         click.echo("插入完成")
 
@@ -429,10 +488,9 @@ def transcriber(ctx: click.Context, mid: int, model: str):
         click.echo(f"没有获取到 {mid} 的 直播回放 系列的回放视频", err=True)
         sys.exit(1)
 
-    total_gpu_time = 0
-    total_archive_duration = 0
-
-    for archive in tqdm.tqdm(archives):
+    # (archive, transcription file) of the archives that are not transcribed yet
+    pending = []
+    for archive in archives:
         pubdate = datetime.fromtimestamp(archive.pubdate, tz=china_tz)
         pubdate_name = pubdate.strftime("%Y-%m-%d_%H-%M-%S")
 
@@ -458,15 +516,41 @@ def transcriber(ctx: click.Context, mid: int, model: str):
 
         transcription_file = f"{root}/{mid}/{pubdate.year}/{pubdate.month:02d}/{recording_dir_name}/segments.json"
         if not os.path.exists(transcription_file):
+            pending.append((archive, transcription_file))
+        else:
+            logger.info(f"已存在 {recording_dir_name} 的转写结果, 跳过")
+
+    # Download the next archives in the background while the GPU transcribes the
+    # current one. The queue bounds how many downloaded archives wait on disk.
+    downloads = queue.Queue(maxsize=DOWNLOAD_AHEAD)
+
+    def _download_pending():
+        for archive, transcription_file in pending:
             try:
-                gpu_time = download_and_transcribe(archive, transcription_file, model)
-                total_gpu_time += gpu_time
-                total_archive_duration += archive.duration
+                audio_files = download(archive)
             except Exception as e:
-                logger.error(f"下载和转写 {archive.bvid} 失败, 跳过: {e}")
+                downloads.put((archive, transcription_file, e))
                 continue
-        else:
-            logger.info(f"已存在 {recording_dir_name} 的转写结果, 跳过")
+            downloads.put((archive, transcription_file, audio_files))
+
+    threading.Thread(target=_download_pending, daemon=True).start()
+
+    total_gpu_time = 0
+    total_archive_duration = 0
+
+    for _ in tqdm.tqdm(range(len(pending))):
+        archive, transcription_file, audio_files = downloads.get()
+        if isinstance(audio_files, Exception):
+            logger.error(f"下载和转写 {archive.bvid} 失败, 跳过: {audio_files}")
+            continue
+
+        try:
+            gpu_time = transcribe(audio_files, transcription_file, model)
+            total_gpu_time += gpu_time
+            total_archive_duration += archive.duration
+        except Exception as e:
+            logger.error(f"下载和转写 {archive.bvid} 失败, 跳过: {e}")
+            continue
 
     click.echo(f"总GPU时间: {total_gpu_time} 秒")
     click.echo(f"总时长: {total_archive_duration} 秒")
@@ -505,44 +589,116 @@ def search(ctx: click.Context, bvid: str, text: str):
     click.echo(f"开始时间: {start}")
 
 
-def get_all_archives_local(root: str, mid: int) -> list[Archive]:
-    archives = []
-    for year in os.listdir(f"{root}/{mid}"):
-        for month in os.listdir(f"{root}/{mid}/{year}"):
-            for recording_dir_name in os.listdir(f"{root}/{mid}/{year}/{month}"):
-                meta_file = (
-                    f"{root}/{mid}/{year}/{month}/{recording_dir_name}/meta.json"
-                )
-                if os.path.exists(meta_file):
-                    with open(meta_file, "r") as f:
-                        meta = json.load(f)
-                        archives.append(
-                            Archive(
-                                id=None,
-                                bvid=meta["bvid"],
-                                title=meta["title"],
-                                pubdate=meta["pubdate"],
-                                duration=meta["duration"],
-                                cover=meta["cover"],
-                            )
-                        )
-    return archives
-
-
-def find_transcript_from_bvid(root: str, bvid: str) -> dict | None:
-    for mid in os.listdir(root):
-        for year in os.listdir(f"{root}/{mid}"):
-            for month in os.listdir(f"{root}/{mid}/{year}"):
-                for recording_dir_name in os.listdir(f"{root}/{mid}/{year}/{month}"):
-                    if bvid in recording_dir_name:
-                        transcript_file = f"{root}/{mid}/{year}/{month}/{recording_dir_name}/segments.json"
-                        if not os.path.exists(transcript_file):
-                            return None
-                        with open(
-                            f"{root}/{mid}/{year}/{month}/{recording_dir_name}/segments.json",
-                            "r",
-                        ) as f:
-                            return json.load(f)
+def _read_json(path: str):
+    """
+    Read a JSON file. The file is read as bytes so that json.loads detects its UTF-8
+    encoding, rather than decoding it with the locale's encoding as a text-mode open
+    would.
+    """
+    with open(path, "rb") as f:
+        return json.loads(f.read())
+
+
+def _list_object_keys(s3, bucket: str, prefix: str) -> set[str]:
+    """
+    List the keys of all the objects under a prefix in a bucket.
+    """
+    keys = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.update(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
+
+def _subdirs(path: str):
+    """
+    Yield the subdirectories of a directory as os.DirEntry, whose is_dir() reuses the
+    file type scandir already read instead of issuing a stat per entry.
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield entry
+
+
+def _scan_recordings(root: str, mid: int | None = None):
+    """
+    Walk the recording directories laid out by the transcriber command.
+
+    Args:
+        root: Root directory for vcut operations
+        mid: If given, only walk the recordings of this user
+
+    Yields:
+        (mid, year, month, recording_dir_name, recording_dir_path) of every recording directory.
+    """
+    if mid is not None:
+        mid_dirs = [(str(mid), f"{root}/{mid}")]
+    else:
+        mid_dirs = [(entry.name, entry.path) for entry in _subdirs(root)]
+
+    for mid_name, mid_path in mid_dirs:
+        for year in _subdirs(mid_path):
+            for month in _subdirs(year.path):
+                for recording_dir in _subdirs(month.path):
+                    yield (
+                        mid_name,
+                        year.name,
+                        month.name,
+                        recording_dir.name,
+                        recording_dir.path,
+                    )
+
+
+def iter_all_archives_local(root: str, mid: int) -> Iterator[Archive]:
+    for _, _, _, _, recording_dir in _scan_recordings(root, mid):
+        try:
+            meta = _read_json(f"{recording_dir}/meta.json")
+        except FileNotFoundError:
+            continue
+        yield Archive(
+            id=None,
+            bvid=meta["bvid"],
+            title=meta["title"],
+            pubdate=meta["pubdate"],
+            duration=meta["duration"],
+            cover=meta["cover"],
+        )
+
+
+def _index_transcripts(root: str) -> dict[str, str]:
+    """
+    Map the bvid of every local recording to the path of its transcript file, which
+    may not exist yet if the recording hasn't been transcribed.
+    """
+    index = {}
+    for _, _, _, recording_dir_name, recording_dir in _scan_recordings(root):
+        index[_bvid_from_dir_name(recording_dir_name)] = f"{recording_dir}/segments.json"
+    return index
+
+
+def _bvid_from_dir_name(recording_dir_name: str) -> str:
+    # <year>-<month>-<day>_<hour>-<minute>-<second>_<bvid>
+    return recording_dir_name.rsplit("_", 1)[-1]
+
+
+def _read_transcript(transcript_file: str) -> list[list[dict]]:
+    return _read_json(transcript_file)
+
+
+def _load_transcript(transcript_file: str | None) -> list[list[dict]] | None:
+    if transcript_file is None:
+        return None
+    try:
+        return _read_transcript(transcript_file)
+    except FileNotFoundError:
+        return None
+
+
+def find_transcript_from_bvid(root: str, bvid: str) -> list[list[dict]] | None:
+    for _, _, _, recording_dir_name, recording_dir in _scan_recordings(root):
+        if _bvid_from_dir_name(recording_dir_name) == bvid:
+            return _load_transcript(f"{recording_dir}/segments.json")
     return None
 
 
@@ -583,7 +739,7 @@ def transcript_key(mid: int, recording: dict) -> str:
     bvid = recording["bvid"]
     pubdate = recording["pubdate"]
     # Extract year, month, day from pudate in tz Asia/Shanghai
-    pubdate = datetime.fromtimestamp(pubdate, tz=pytz.timezone("Asia/Shanghai"))
+    pubdate = datetime.fromtimestamp(pubdate, tz=SHANGHAI_TZ)
     year = pubdate.year
     month = pubdate.month
     day = pubdate.day
@@ -1,7 +1,16 @@
+from operator import itemgetter
 import psycopg
 
+# occurrence -> row in the order of the inserted columns
+_occurrence_row = itemgetter("song_id", "vtuber_song_id", "archive_id", "start", "page")
 
-def create_occurrences(conn: psycopg.Connection, occurrences: list[dict]) -> int:
+# Batches of at least this many occurrences are staged with COPY rather than sent as
+# arrays. Below it the staging table and the extra INSERT ... SELECT cost more than the
+# arrays, above it COPY's cheaper per-row encoding wins. dblocal uses it too.
+COPY_THRESHOLD = 1000
+
+
+def create_occurrences(conn: psycopg.Connection, occurrences: list[dict], commit: bool = True) -> int:
     """
     Create occurrences in the database.
 
@@ -14,16 +23,58 @@ def create_occurrences(conn: psycopg.Connection, occurrences: list[dict]) -> int
             - archive_id: The liver recording archive ID.
             - start: The start time of the occurrence, in seconds.
             - page: The page of the occurrence.
+        commit: Whether to commit the insert, pass False to batch it with other writes.
+            Batches of COPY_THRESHOLD occurrences or more use COPY, which can't run
+            in pipeline mode.
 
     Returns:
         The number of rows created.
     """
 
+    if not occurrences:
+        return 0
+
     with conn.cursor() as cursor:
-        # Split the occurrences into chunks of 50 to avoid db error
-        for chunk in [occurrences[i : i + 50] for i in range(0, len(occurrences), 50)]:
-            cursor.executemany(
+        if len(occurrences) >= COPY_THRESHOLD:
+            # COPY streams the rows without building one array per column, but it can't
+            # resolve conflicts, so the rows go through a staging table dropped on commit.
+            cursor.execute(
                 """
+                CREATE TEMP TABLE "SongOccurrenceInLiveStaging" (
+                    "songId" bigint,
+                    "vtuberSongId" bigint,
+                    "liveRecordingArchiveId" bigint,
+                    "start" float8,
+                    "page" bigint
+                ) ON COMMIT DROP;
+                """
+            )
+            with cursor.copy('COPY "SongOccurrenceInLiveStaging" FROM STDIN WITH (FORMAT BINARY)') as copy:
+                copy.set_types(["int8", "int8", "int8", "float8", "int8"])
+                for song_id, vtuber_song_id, archive_id, start, page in map(_occurrence_row, occurrences):
+                    copy.write_row((song_id, vtuber_song_id, archive_id, float(start), page))
+            source = 'SELECT * FROM "SongOccurrenceInLiveStaging"'
+            params = None
+        else:
+            # Transpose the rows into one list per column
+            song_ids, vtuber_song_ids, archive_ids, starts, pages = (
+                list(column) for column in zip(*map(_occurrence_row, occurrences))
+            )
+            # One array per column keeps the statement the same whatever the number of rows.
+            # The arrays are sent in binary (%b), which is smaller than their text form and
+            # skips parsing on the server.
+            source = "SELECT * FROM UNNEST(%b::bigint[], %b::bigint[], %b::bigint[], %b::float8[], %b::bigint[])"
+            params = (
+                song_ids,
+                vtuber_song_ids,
+                archive_ids,
+                # A binary array holds one type, the starts can mix ints and floats
+                [float(start) for start in starts],
+                pages,
+            )
+
+        cursor.execute(
+            f"""
             INSERT INTO "SongOccurrenceInLive" (
                 "songId",
                 "vtuberSongId",
@@ -31,21 +82,16 @@ def create_occurrences(conn: psycopg.Connection, occurrences: list[dict]) -> int
                 "start",
                 "page"
             )
-            VALUES (%s, %s, %s, %s, %s)
+            {source}
             ON CONFLICT ("vtuberSongId", "liveRecordingArchiveId") DO UPDATE SET
                 "start" = EXCLUDED."start",
                 "page" = EXCLUDED."page";
             """,
-                [
-                    (
-                        occurrence["song_id"],
-                        occurrence["vtuber_song_id"],
-                        occurrence["archive_id"],
-                        occurrence["start"],
-                        occurrence["page"],
-                    )
-                    for occurrence in chunk
-                ],
-            )
+            params,
+        )
+        if params is None:
+            # Let later batches of the same transaction stage their own rows
+            cursor.execute('DROP TABLE "SongOccurrenceInLiveStaging";')
+        if commit:
             conn.commit()
         return cursor.rowcount
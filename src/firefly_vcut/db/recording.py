@@ -1,10 +1,53 @@
 from datetime import datetime
+from operator import itemgetter
 import re
 import psycopg
 from psycopg.rows import dict_row
 import pytz
 
-def create_recordings(conn: psycopg.Connection, recordings: list[dict], mid: int) -> int:
+TITLE_DATETIME_PATTERN = re.compile(r"(\d{4})年(\d{1,2})月(\d{1,2})日(\d{1,2})点场")
+SHANGHAI_TZ = pytz.timezone("Asia/Shanghai")
+
+# recording -> the inserted columns that are copied as is
+_recording_row = itemgetter("title", "bvid", "pubdate", "duration", "cover")
+
+# mid -> VtuberProfile id, see get_vtuber_profile_id
+_vtuber_profile_ids: dict[int, int] = {}
+
+def get_vtuber_profile_id(cursor: psycopg.Cursor, mid: int) -> int:
+    """
+    Get the id of the vtuber profile with the given mid. Profiles are never re-keyed, so
+    the ids are cached for the lifetime of the process.
+
+    Args:
+        cursor: A cursor to run the lookup with, so callers can reuse the one they insert with.
+        mid: The vtuber mid.
+
+    Returns:
+        The vtuber profile ID.
+    """
+    if mid not in _vtuber_profile_ids:
+        cursor.execute(
+            """
+            SELECT "id" FROM "VtuberProfile" WHERE "mid" = %s;
+        """,
+            (mid,),
+        )
+        _vtuber_profile_ids[mid] = cursor.fetchone()[0]
+    return _vtuber_profile_ids[mid]
+
+def extract_datetime_from_title(title: str) -> datetime | None:
+    """
+    Bilibili live recordings are named like "2025年8月10日1点场 <title>", which is the only way of knowing
+    when the live happened instead of when the recording was published, so we try to extract the datetime from the title.
+    """
+    match = TITLE_DATETIME_PATTERN.search(title)
+    if match:
+        year, month, day, hour = map(int, match.groups())
+        return SHANGHAI_TZ.localize(datetime(year, month, day, hour, 0, 0))
+    return None
+
+def create_recordings(conn: psycopg.Connection, recordings: list[dict], mid: int, commit: bool = True) -> int:
     """
     Create new recordings in the database.
 
@@ -17,52 +60,50 @@ def create_recordings(conn: psycopg.Connection, recordings: list[dict], mid: int
             - pubdate: The publication date of the video, unix epoch timestamp, meant to be consumed
             - duration: The duration of the recording in seconds.
             - cover: The cover image of the recording.
+        commit: Whether to commit the insert, pass False to batch it with other writes.
+
+    Returns:
+        The number of rows created.
     """
 
-    def extract_datetime_from_title(title: str) -> datetime | None:
-        """
-        Bilibili live recordings are named like "2025年8月10日1点场 <title>", which is the only way of knowing
-        when the live happened instead of when the recording was published, so we try to extract the datetime from the title.
-        """
-        tz = pytz.timezone("Asia/Shanghai")
-        pattern = r"(\d{4})年(\d{1,2})月(\d{1,2})日(\d{1,2})点场"
-        match = re.search(pattern, title)
-        if match:
-            year, month, day, hour = map(int, match.groups())
-            return tz.localize(datetime(year, month, day, hour, 0, 0))
-        return None
-    
-    with conn.cursor() as cursor:
-        cursor.execute(
-            """
-            SELECT "id" FROM "VtuberProfile" WHERE "mid" = %s;
-        """,
-            (mid,),
-        )
-        vtuber_profile_id = cursor.fetchone()[0]
+    # Skip recordings that has no dates
+    rows = [
+        (*_recording_row(recording), date)
+        for recording in recordings
+        if (date := extract_datetime_from_title(recording["title"])) is not None
+    ]
+    if not rows:
+        return 0
+
+    # Transpose the rows into one list per column
+    titles, bvids, pubdates, durations, covers, dates = (
+        list(column) for column in zip(*rows)
+    )
 
     with conn.cursor() as cursor:
-        cursor.executemany(
+        vtuber_profile_id = get_vtuber_profile_id(cursor, mid)
+        # One array per column keeps the statement the same whatever the number of rows,
+        # see db.occurrence.create_occurrences for the binary (%b) arrays.
+        cursor.execute(
             """
                 INSERT INTO "LiveRecordingArchive" ("title", "bvid", "vtuberProfileId", "pubdate", "date", "duration", "cover")
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                SELECT "title", "bvid", %s, "pubdate", "date", "duration", "cover"
+                FROM UNNEST(%b::text[], %b::text[], %b::bigint[], %b::timestamptz[], %b::bigint[], %b::text[])
+                    AS t("title", "bvid", "pubdate", "date", "duration", "cover")
                 ON CONFLICT ("bvid") DO NOTHING;
             """,
-            [
-                (
-                    recording["title"],
-                    recording["bvid"],
-                    vtuber_profile_id,
-                    recording["pubdate"],
-                    extract_datetime_from_title(recording["title"]),
-                    recording["duration"],
-                    recording["cover"],
-                )
-                for recording in recordings
-                if extract_datetime_from_title(recording["title"]) is not None # Skip recordings that has no dates
-            ],
+            (
+                vtuber_profile_id,
+                titles,
+                bvids,
+                pubdates,
+                dates,
+                durations,
+                covers,
+            ),
         )
-        conn.commit()
+        if commit:
+            conn.commit()
         return cursor.rowcount
 
 def list_latest_and_oldest_recordings(conn: psycopg.Connection) -> list[dict]:
@@ -238,7 +279,7 @@ def list_latest_recordings(conn: psycopg.Connection, limit: int) -> list[dict]:
         """, (limit,))
         return cursor.fetchall()
 
-def update_recording_audio_object_keys(conn: psycopg.Connection, recording_id: int, audio_object_keys: list[str]) -> int:
+def update_recording_audio_object_keys(conn: psycopg.Connection, recording_id: int, audio_object_keys: list[str], commit: bool = True) -> int:
     """
     Update a recording's audio object keys.
 
@@ -246,6 +287,7 @@ def update_recording_audio_object_keys(conn: psycopg.Connection, recording_id: i
         conn: A database connection.
         recording_id: The ID of the recording to update.
         audio_object_keys: A list of audio object keys (path in object store bucket for the audio files, one for each page)
+        commit: Whether to commit the update, pass False to batch it with other writes.
 
     Returns:
         The number of rows updated.
@@ -254,13 +296,15 @@ def update_recording_audio_object_keys(conn: psycopg.Connection, recording_id: i
         cursor.execute("""
             UPDATE "LiveRecordingArchive" SET "audioObjectKeys" = %s WHERE "id" = %s;
         """, (audio_object_keys, recording_id))
-        conn.commit()
+        if commit:
+            conn.commit()
         return cursor.rowcount
 
 def update_recording_transcript(
     conn: psycopg.Connection,
     recording_id: int,
     transcript_object_key: str,
+    commit: bool = True,
 ):
     """
     Update a recording's transcript, and also remove the audio object keys
@@ -270,6 +314,7 @@ def update_recording_transcript(
         conn: A database connection.
         recording_id: The ID of the recording to update.
         transcript_object_key: The object key of the transcript in the object store.
+        commit: Whether to commit the update, pass False to batch it with other writes.
 
     Returns:
         The number of rows updated.
@@ -281,21 +326,27 @@ def update_recording_transcript(
         """,
             (transcript_object_key, recording_id),
         )
-        conn.commit()
+        if commit:
+            conn.commit()
         return cursor.rowcount
 
-def mark_recording_scanned(conn: psycopg.Connection, recording_id: int) -> int:
+def mark_recordings_scanned(conn: psycopg.Connection, recording_ids: list[int], commit: bool = True) -> int:
     """
-    Mark a recording as scanned.
+    Mark recordings as scanned.
 
     Args:
         conn: A database connection.
-        recording_id: The ID of the recording to mark as scanned.
+        recording_ids: The IDs of the recordings to mark as scanned.
+        commit: Whether to commit the update, pass False to batch it with other writes.
+
+    Returns:
+        The number of rows updated.
     """
-    with conn.cursor() as cursor:  
+    with conn.cursor() as cursor:
         cursor.execute("""
-            UPDATE "LiveRecordingArchive" SET "lastSongOccurrenceScan" = NOW() WHERE "id" = %s;
-        """, (recording_id,))
-        conn.commit()
+            UPDATE "LiveRecordingArchive" SET "lastSongOccurrenceScan" = NOW() WHERE "id" = ANY(%s);
+        """, (recording_ids,))
+        if commit:
+            conn.commit()
         return cursor.rowcount
 
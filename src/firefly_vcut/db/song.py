@@ -1,3 +1,4 @@
+from collections.abc import Iterator
 import psycopg
 from psycopg.rows import dict_row
 
@@ -20,23 +21,27 @@ def list_latest_bvid_by_vtuber(conn: psycopg.Connection) -> list[dict]:
             SELECT
                 vp."id" as "vtuber_profile_id",
                 vp."mid" as "mid",
-                MAX(vs."pubdate") as "latest_video_pubdate"
-            FROM "VtuberProfile" vp
-            LEFT JOIN "VtuberSong" vs ON vs."vtuberProfileId" = vp."id"
-            GROUP BY vp."id";
+                -- One lookup per vtuber instead of aggregating the join of all their songs,
+                -- an index on ("vtuberProfileId", "pubdate") answers it from the index alone.
+                (
+                    SELECT MAX(vs."pubdate")
+                    FROM "VtuberSong" vs
+                    WHERE vs."vtuberProfileId" = vp."id"
+                ) as "latest_video_pubdate"
+            FROM "VtuberProfile" vp;
         """)
         return cursor.fetchall()
 
-def list_vtuber_songs_by_vtuber_profile_id(conn: psycopg.Connection) -> list[dict]:
+def iter_vtuber_songs_by_vtuber_profile_id(conn: psycopg.Connection) -> Iterator[dict]:
     """
-    List a flattened list of vtuber songs
+    Iterate over a flattened list of vtuber songs. The rows are turned into dictionaries
+    one at a time as they are consumed, so consume them before closing the connection.
 
     Args:
         conn: A database connection.
-        vtuber_profile_id: The vtuber profile ID.
 
     Returns:
-        A list of vtuber songs.
+        An iterator of vtuber songs.
         Each vtuber song is a dictionary with the following keys:
         - vtuber_profile_id: The vtuber profile ID.
         - id: The song ID.
@@ -54,7 +59,7 @@ def list_vtuber_songs_by_vtuber_profile_id(conn: psycopg.Connection) -> list[dic
             FROM "VtuberSong" vs
             JOIN "Song" s ON vs."songId" = s."id";
         """)
-        return cursor.fetchall()
+        yield from cursor
 
 def update_bvid(conn: psycopg.Connection, entries: list[dict]) -> int:
     """
@@ -72,14 +77,26 @@ def update_bvid(conn: psycopg.Connection, entries: list[dict]) -> int:
     Returns:
         The number of updated entries.
     """
+    # UPDATE ... FROM applies an arbitrary one of several source rows for the same target,
+    # keep the last entry of each vtuber song as applying them one by one would.
+    latest = {entry["vtuber_song_id"]: entry for entry in entries}
+    if not latest:
+        return 0
+
     with conn.cursor() as cursor:
-        cursor.executemany(
+        # One statement for all entries instead of one per entry
+        cursor.execute(
             """
             UPDATE "VtuberSong" vs
-            SET "bvid" = %s, "pubdate" = %s
-            WHERE vs."id" = %s;
+            SET "bvid" = v."bvid", "pubdate" = v."pubdate"
+            FROM UNNEST(%b::bigint[], %b::text[], %b::bigint[]) AS v("id", "bvid", "pubdate")
+            WHERE vs."id" = v."id";
             """,
-            [(entry["bvid"], entry["pubdate"], entry["vtuber_song_id"]) for entry in entries]
+            (
+                list(latest),
+                [entry["bvid"] for entry in latest.values()],
+                [entry["pubdate"] for entry in latest.values()],
+            ),
         )
         conn.commit()
         return cursor.rowcount
@@ -95,8 +112,8 @@ def list_all_songs_with_vtuber_song_ids(conn: psycopg.Connection) -> list[dict]:
         A list of songs.
         Each song is a dictionary with the following keys:
         - id: The song ID.
-        - vtuber_song_ids: A list of VtuberSong ids associated with this song.
-        - vtuber_profile_ids: A list of VtuberProfile ids associated with this song.
+        - vtuber_songs: The VtuberSongs associated with this song, each a dictionary with the keys
+            vtuber_song_id and vtuber_profile_id.
         - title: The title of the song.
         - lyrics_fragment: The lyrics of the song.
     """
@@ -107,14 +124,54 @@ def list_all_songs_with_vtuber_song_ids(conn: psycopg.Connection) -> list[dict]:
                 s."id" as "id",
                 s."title" as "title",
                 s."lyricsFragment" as "lyrics_fragment",
-                ARRAY_AGG(vs."id") as "vtuber_song_ids",
-                ARRAY_AGG(vs."vtuberProfileId") as "vtuber_profile_ids"
+                COALESCE(vs."vtuber_songs", '[]') as "vtuber_songs"
             FROM "Song" s
-            LEFT JOIN "VtuberSong" vs ON s."id" = vs."songId"
-            GROUP BY s."id";
+            -- Aggregate each song's own VtuberSong rows (an index lookup on "songId")
+            -- instead of hash-aggregating the whole join.
+            CROSS JOIN LATERAL (
+                SELECT
+                    JSONB_AGG(
+                        JSONB_BUILD_OBJECT(
+                            'vtuber_song_id', vs."id",
+                            'vtuber_profile_id', vs."vtuberProfileId"
+                        )
+                        ORDER BY vs."id"
+                    ) as "vtuber_songs"
+                FROM "VtuberSong" vs
+                WHERE vs."songId" = s."id"
+            ) vs;
         """)
         return cursor.fetchall()
 
+def list_songs_by_vtuber_profile_id(conn: psycopg.Connection, vtuber_profile_id: int) -> list[dict]:
+    """
+    List the songs of a vtuber.
+
+    Args:
+        conn: A database connection.
+        vtuber_profile_id: The vtuber profile ID.
+
+    Returns:
+        A list of songs, one for each VtuberSong of the vtuber.
+        Each song is a dictionary with the following keys:
+        - id: The song ID.
+        - vtuber_song_id: The VtuberSong ID.
+        - title: The title of the song.
+        - lyrics_fragment: The lyrics of the song.
+    """
+    with conn.cursor(row_factory=dict_row) as cursor:
+        cursor.execute("""
+            SELECT
+                s."id" as "id",
+                vs."id" as "vtuber_song_id",
+                s."title" as "title",
+                s."lyricsFragment" as "lyrics_fragment"
+            FROM "VtuberSong" vs
+            JOIN "Song" s ON vs."songId" = s."id"
+            WHERE vs."vtuberProfileId" = %s;
+        """, (vtuber_profile_id,))
+        return cursor.fetchall()
+
 def list_songs_by_title(conn: psycopg.Connection, title: str) -> list[dict] | None:
     """
     List songs by title.
@@ -127,8 +184,8 @@ def list_songs_by_title(conn: psycopg.Connection, title: str) -> list[dict] | No
         A song.
         A dictionary with the following keys:
         - id: The song ID.
-        - vtuber_song_ids: A list of VtuberSong ids associated with this song.
-        - vtuber_profile_ids: A list of VtuberProfile ids associated with this song.
+        - vtuber_songs: The VtuberSongs associated with this song, each a dictionary with the keys
+            vtuber_song_id and vtuber_profile_id.
         - title: The title of the song.
         - lyrics_fragment: The lyrics of the song.
     """
@@ -138,11 +195,21 @@ def list_songs_by_title(conn: psycopg.Connection, title: str) -> list[dict] | No
                 s."id" as "id",
                 s."title" as "title",
                 s."lyricsFragment" as "lyrics_fragment",
-                ARRAY_AGG(vs."id") as "vtuber_song_ids",
-                ARRAY_AGG(vs."vtuberProfileId") as "vtuber_profile_ids"
+                COALESCE(vs."vtuber_songs", '[]') as "vtuber_songs"
             FROM "Song" s
-            LEFT JOIN "VtuberSong" vs ON s."id" = vs."songId"
-            WHERE s."title" = %s
-            GROUP BY s."id";
+            -- See list_all_songs_with_vtuber_song_ids
+            CROSS JOIN LATERAL (
+                SELECT
+                    JSONB_AGG(
+                        JSONB_BUILD_OBJECT(
+                            'vtuber_song_id', vs."id",
+                            'vtuber_profile_id', vs."vtuberProfileId"
+                        )
+                        ORDER BY vs."id"
+                    ) as "vtuber_songs"
+                FROM "VtuberSong" vs
+                WHERE vs."songId" = s."id"
+            ) vs
+            WHERE s."title" = %s;
         """, (title,))
         return cursor.fetchall()
\ No newline at end of file
@@ -1,11 +1,74 @@
+import csv
+import io
 import psycopg2
+from collections.abc import Iterable, Iterator
 from contextlib import contextmanager
+from itertools import starmap
+from operator import attrgetter
 from psycopg2.extras import execute_values
+from .db.occurrence import COPY_THRESHOLD
 from .types import Archive, VtuberSong, SongOccurrence
 from datetime import datetime
 import re
 import pytz
 
+# Number of rows server-side cursors fetch per round trip.
+STREAM_BATCH_SIZE = 2000
+
+# mid -> VtuberProfile id, see _get_vtuber_profile_id
+_vtuber_profile_ids: dict[str, int] = {}
+
+TITLE_DATETIME_PATTERN = re.compile(r'(\d{4})年(\d{1,2})月(\d{1,2})日(\d{1,2})点场')
+SHANGHAI_TZ = pytz.timezone('Asia/Shanghai')
+
+ARCHIVE_INSERT_COLUMNS = '"vtuberProfileId", "bvid", "title", "pubdate", "date", "duration", "cover"'
+OCCURRENCE_INSERT_COLUMNS = '"songId", "vtuberSongId", "liveRecordingArchiveId", "start", "page"'
+# SongOccurrence -> row in the order of OCCURRENCE_INSERT_COLUMNS
+_occurrence_row = attrgetter("song_id", "vtuber_song_id", "archive_id", "start", "page")
+
+
+# Archive columns in the order of the Archive fields, so rows map onto Archive(*row).
+ARCHIVE_COLUMNS = "a.id, a.bvid, a.title, a.pubdate, a.cover, a.duration"
+
+
+def _fetch_all(cursor, row_type) -> list:
+    """
+    Build a row_type out of every remaining row of the cursor, fetching the rows in
+    batches of STREAM_BATCH_SIZE. Columns must be selected in the field order of row_type.
+    """
+    results = []
+    rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+    while rows:
+        results.extend(starmap(row_type, rows))
+        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+    return results
+
+
+def _get_vtuber_profile_id(cursor, mid: str) -> int | None:
+    """
+    Get the id of the vtuber profile with the given mid, using the caller's cursor, or None
+    if there is no such profile. Profiles are never re-keyed, so the ids are cached for the
+    lifetime of the process.
+    """
+    if mid not in _vtuber_profile_ids:
+        cursor.execute(
+            'SELECT "id" FROM "VtuberProfile" WHERE "mid" = %s', (mid,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        _vtuber_profile_ids[mid] = row[0]
+    return _vtuber_profile_ids[mid]
+
+
+def _profile_id(conn: psycopg2.extensions.connection, mid: int) -> int | None:
+    """
+    The VtuberProfile id of mid, so reads can filter on "vtuberProfileId" instead of
+    joining VtuberProfile. An unknown mid gives None, which matches no rows.
+    """
+    with conn.cursor() as cursor:
+        return _get_vtuber_profile_id(cursor, str(mid))
+
 
 @contextmanager
 def get_db_connection(db_url: str):
@@ -15,181 +78,224 @@ def get_db_connection(db_url: str):
     finally:
         conn.close()
 
-def get_all_archives_from_db(conn: psycopg2.extensions.connection, mid: int) -> list[Archive]:
-    mid = str(mid)
+def iter_all_archives_from_db(conn: psycopg2.extensions.connection, mid: int) -> Iterator[Archive]:
+    """
+    Stream all the archives of a user from the database. Rows are fetched from a
+    server-side cursor in batches of STREAM_BATCH_SIZE, so the whole table never has
+    to be held in memory. The cursor is held across commits, the caller may write
+    while iterating.
+    """
+    vtuber_profile_id = _profile_id(conn, mid)
+
+    with conn.cursor(name="archives_stream", withhold=True) as cursor:
+        cursor.itersize = STREAM_BATCH_SIZE
+        cursor.execute(
+            f'SELECT {ARCHIVE_COLUMNS} FROM "LiveRecordingArchive" a WHERE a."vtuberProfileId" = %s;',
+            (vtuber_profile_id,)
+        )
+        yield from starmap(Archive, cursor)
+
+def get_existing_bvids(conn: psycopg2.extensions.connection, mid: int) -> set[str]:
+    """
+    Get the bvids of all the archives of a user in the database, without loading the
+    rest of the archive rows.
+    """
+    vtuber_profile_id = _profile_id(conn, mid)
 
-    archives = []
     with conn.cursor() as cursor:
         cursor.execute(
-            'SELECT a.id, a.bvid, a.title, a.pubdate, a.duration, a.cover FROM "LiveRecordingArchive" a JOIN "VtuberProfile" v ON a."vtuberProfileId" = v."id" WHERE v."mid" = %s;',
-            (mid,)
+            'SELECT a.bvid FROM "LiveRecordingArchive" a WHERE a."vtuberProfileId" = %s;',
+            (vtuber_profile_id,)
         )
-        for id, bvid, title, pubdate, duration, cover in cursor:
-            archives.append(
-                Archive(
-                    id=id,
-                    bvid=bvid,
-                    title=title,
-                    pubdate=pubdate,
-                    duration=duration,
-                    cover=cover,
-                )
-            )
-    return archives
+        return {bvid for (bvid,) in cursor}
 
 def get_latest_archives_from_db(conn: psycopg2.extensions.connection, mid: int, count: int) -> list[Archive]:
-    mid = str(mid)
+    vtuber_profile_id = _profile_id(conn, mid)
 
-    archives = []
     with conn.cursor() as cursor:
         cursor.execute(
-            'SELECT a.id, a.bvid, a.title, a.pubdate, a.duration, a.cover FROM "LiveRecordingArchive" a JOIN "VtuberProfile" v ON a."vtuberProfileId" = v."id" WHERE v."mid" = %s ORDER BY id DESC LIMIT %s', (mid, count))
-        for id, bvid, title, pubdate, duration, cover in cursor:
-            archives.append(Archive(id=id, bvid=bvid, title=title, pubdate=pubdate, duration=duration, cover=cover))
-    return archives
+            f'SELECT {ARCHIVE_COLUMNS} FROM "LiveRecordingArchive" a WHERE a."vtuberProfileId" = %s ORDER BY a.id DESC LIMIT %s', (vtuber_profile_id, count))
+        return _fetch_all(cursor, Archive)
 
 def get_archives_by_bvid(
     conn: psycopg2.extensions.connection, bvid: str
 ) -> list[Archive]:
-    archives = []
     with conn.cursor() as cursor:
         cursor.execute(
-            'SELECT id, bvid, title, pubdate, duration, cover FROM "LiveRecordingArchive" WHERE bvid = %s',
+            f'SELECT {ARCHIVE_COLUMNS} FROM "LiveRecordingArchive" a WHERE a.bvid = %s',
             (bvid,),
         )
-        for id, bvid, title, pubdate, duration, cover in cursor:
-            archives.append(
-                Archive(
-                    id=id,
-                    bvid=bvid,
-                    title=title,
-                    pubdate=pubdate,
-                    duration=duration,
-                    cover=cover,
-                )
-            )
-    return archives
+        return _fetch_all(cursor, Archive)
 
 
 def get_all_vtuber_songs_from_db(conn: psycopg2.extensions.connection, mid: int) -> list[VtuberSong]:
-    mid = str(mid)
+    vtuber_profile_id = _profile_id(conn, mid)
 
     stmt = """
     SELECT s1."id", s2."id", s1."title", s1."lyricsFragment"
-    FROM "Song" s1 JOIN "VtuberSong" s2 ON s1."id" = s2."songId" JOIN "VtuberProfile" v ON s2."vtuberProfileId" = v."id"
-    WHERE v."mid" = %s AND s1."lyricsFragment" IS NOT NULL AND s1."lyricsFragment" != ''
+    FROM "Song" s1 JOIN "VtuberSong" s2 ON s1."id" = s2."songId"
+    WHERE s2."vtuberProfileId" = %s AND s1."lyricsFragment" IS NOT NULL AND s1."lyricsFragment" != ''
     """
 
-    songs = []
     with conn.cursor() as cursor:
-        cursor.execute(stmt, (mid,))
-        for song_id, vtuber_song_id, title, lyrics_fragment in cursor:
-            songs.append(VtuberSong(song_id=song_id, vtuber_song_id=vtuber_song_id, title=title, lyrics_fragment=lyrics_fragment))
-    return songs
+        cursor.execute(stmt, (vtuber_profile_id,))
+        return _fetch_all(cursor, VtuberSong)
 
 
 def get_vtuber_song_by_title(conn: psycopg2.extensions.connection, title: str, mid: int) -> list[VtuberSong]:
-    mid = str(mid)
+    vtuber_profile_id = _profile_id(conn, mid)
 
     stmt = """
     SELECT s1."id", s2."id", s1."title", s1."lyricsFragment"
-    FROM "Song" s1 JOIN "VtuberSong" s2 ON s1."id" = s2."songId" JOIN "VtuberProfile" v ON s2."vtuberProfileId" = v."id"
-    WHERE v."mid" = %s AND s1."title" = %s AND s1."lyricsFragment" IS NOT NULL AND s1."lyricsFragment" != ''
+    FROM "Song" s1 JOIN "VtuberSong" s2 ON s1."id" = s2."songId"
+    WHERE s2."vtuberProfileId" = %s AND s1."title" = %s AND s1."lyricsFragment" IS NOT NULL AND s1."lyricsFragment" != ''
     """
-    songs = []
     with conn.cursor() as cursor:
-        cursor.execute(stmt, (mid, title))
-        for song_id, vtuber_song_id, title, lyrics_fragment in cursor:
-            songs.append(VtuberSong(song_id=song_id, vtuber_song_id=vtuber_song_id, title=title, lyrics_fragment=lyrics_fragment))
-    return songs
+        cursor.execute(stmt, (vtuber_profile_id, title))
+        return _fetch_all(cursor, VtuberSong)
 
 
-def get_all_occurrences_from_db(
+def iter_all_occurrences_from_db(
     conn: psycopg2.extensions.connection,
     mid: int,
-) -> list[SongOccurrence]:
+) -> Iterator[SongOccurrence]:
     """
-    Retrieve all song occurrences from the database.
+    Stream all song occurrences from the database, see iter_all_archives_from_db.
 
     Note: Double quotes around column names are required because PostgreSQL treats unquoted
     identifiers as lowercase by default. Since our table uses camelCase column names
     ("songId", "liveRecordingArchiveId"), we must quote them to preserve the exact case.
     """
 
-    mid = str(mid)
+    vtuber_profile_id = _profile_id(conn, mid)
 
     stmt = """
     SELECT s1."songId", s1."vtuberSongId", s1."liveRecordingArchiveId", s1."start", s1."page"
-    FROM "SongOccurrenceInLive" s1 JOIN "VtuberSong" s2 ON s1."vtuberSongId" = s2."id" JOIN "VtuberProfile" v ON s2."vtuberProfileId" = v."id"
-    WHERE v."mid" = %s
+    FROM "SongOccurrenceInLive" s1 JOIN "VtuberSong" s2 ON s1."vtuberSongId" = s2."id"
+    WHERE s2."vtuberProfileId" = %s
+    """
+
+    with conn.cursor(name="occurrences_stream") as cursor:
+        cursor.itersize = STREAM_BATCH_SIZE
+        cursor.execute(stmt, (vtuber_profile_id,))
+        yield from starmap(SongOccurrence, cursor)
+
+
+def get_occurrence_keys(
+    conn: psycopg2.extensions.connection,
+    vtuber_song_ids: list[int],
+    archive_ids: list[int],
+) -> set[tuple[int, int]]:
+    """
+    Get the (vtuber_song_id, archive_id) of the song occurrences in the database between
+    the given vtuber songs and archives. Only the key columns of the occurrences we might
+    be about to compute are fetched.
+    """
+
+    stmt = """
+    SELECT "vtuberSongId", "liveRecordingArchiveId"
+    FROM "SongOccurrenceInLive"
+    WHERE "vtuberSongId" = ANY(%s) AND "liveRecordingArchiveId" = ANY(%s)
     """
 
-    occurrences = []
     with conn.cursor() as cursor:
-        cursor.execute(stmt, (mid,))
-        for song_id, vtuber_song_id, archive_id, start, page in cursor:
-            occurrences.append(
-                SongOccurrence(
-                    song_id=song_id,
-                    vtuber_song_id=vtuber_song_id,
-                    archive_id=archive_id,
-                    start=start,
-                    page=page,
-                )
-            )
-    return occurrences
+        cursor.execute(stmt, (vtuber_song_ids, archive_ids))
+        return {(vtuber_song_id, archive_id) for vtuber_song_id, archive_id in cursor}
+
+
+def _copy_to_staging(cursor, table: str, columns: str, rows: list[tuple], force_not_null: str | None = None):
+    """
+    COPY rows into a temporary "<table>Staging" table with the given columns of table,
+    dropped at the end of the transaction. COPY skips parsing the rows as SQL but can't
+    resolve conflicts, so callers move the rows over with INSERT ... SELECT ... ON CONFLICT.
+
+    Args:
+        cursor: A cursor of the connection to stage the rows in.
+        table: The table the rows are meant for.
+        columns: The quoted, comma separated columns of the rows.
+        rows: The rows to copy.
+        force_not_null: The quoted, comma separated columns whose empty values are empty
+            strings rather than NULL.
+    """
+    cursor.execute(
+        f'CREATE TEMP TABLE "{table}Staging" ON COMMIT DROP AS SELECT {columns} FROM "{table}" WITH NO DATA;'
+    )
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    options = "FORMAT csv"
+    if force_not_null:
+        options += f", FORCE_NOT_NULL ({force_not_null})"
+    cursor.copy_expert(f'COPY "{table}Staging" FROM STDIN WITH ({options})', buffer)
+
+
+def extract_datetime_from_title(title: str) -> datetime | None:
+    """Extract datetime from Chinese title format"""
+    match = TITLE_DATETIME_PATTERN.search(title)
+    if match:
+        year, month, day, hour = map(int, match.groups())
+        return SHANGHAI_TZ.localize(datetime(year, month, day, hour, 0, 0))
+    return None
 
 
 def insert_archives_to_db(
     conn: psycopg2.extensions.connection,
-    archives: list[Archive],
+    archives: Iterable[Archive],
     mid: int,
 ):
-    def extract_datetime_from_title(title: str) -> datetime | None:
-        """Extract datetime from Chinese title format"""
-        tz = pytz.timezone('Asia/Shanghai')
-
-        pattern = r'(\d{4})年(\d{1,2})月(\d{1,2})日(\d{1,2})点场'
-        match = re.search(pattern, title)
-        
-        if match:
-            year, month, day, hour = map(int, match.groups())
-            return tz.localize(datetime(year, month, day, hour, 0, 0))
-        return None
-
     mid = str(mid)
 
     with conn.cursor() as cursor:
-        cursor.execute(
-            'SELECT "id" FROM "VtuberProfile" WHERE "mid" = %s', (mid,)
-        )
-        vtuber_profile_id = cursor.fetchone()[0]
+        vtuber_profile_id = _get_vtuber_profile_id(cursor, mid)
+        # The archives would be written without an owner
+        if vtuber_profile_id is None:
+            raise ValueError(f"No vtuber profile with mid {mid}")
 
-    with conn.cursor() as cursor:
-        execute_values(
-            cursor,
-            """
-            INSERT INTO "LiveRecordingArchive" ("vtuberProfileId", "bvid", "title", "pubdate", "date", "duration", "cover") VALUES %s
-            ON CONFLICT (bvid) DO NOTHING;
-            """,
-            [
-                (
-                    vtuber_profile_id,
-                    archive.bvid,
-                    archive.title,
-                    archive.pubdate,
-                    extract_datetime_from_title(archive.title),
-                    archive.duration,
-                    archive.cover,
-                )
-                for archive in archives
-            ],
-        )
+        rows = [
+            (
+                vtuber_profile_id,
+                archive.bvid,
+                archive.title,
+                archive.pubdate,
+                extract_datetime_from_title(archive.title),
+                archive.duration,
+                archive.cover,
+            )
+            for archive in archives
+        ]
+
+        if len(rows) >= COPY_THRESHOLD:
+            # Bulk ingest, e.g. the first sync of a vtuber.
+            _copy_to_staging(
+                cursor,
+                "LiveRecordingArchive",
+                ARCHIVE_INSERT_COLUMNS,
+                rows,
+                # A missing date is NULL, an empty title or cover is not.
+                force_not_null='"bvid", "title", "cover"',
+            )
+            cursor.execute(
+                """
+                INSERT INTO "LiveRecordingArchive" ("vtuberProfileId", "bvid", "title", "pubdate", "date", "duration", "cover")
+                SELECT * FROM "LiveRecordingArchiveStaging"
+                ON CONFLICT (bvid) DO NOTHING;
+                """
+            )
+        else:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO "LiveRecordingArchive" ("vtuberProfileId", "bvid", "title", "pubdate", "date", "duration", "cover") VALUES %s
+                ON CONFLICT (bvid) DO NOTHING;
+                """,
+                rows,
+                page_size=500,
+            )
         conn.commit()
 
 
 def insert_song_occurrences_to_db(
-    conn: psycopg2.extensions.connection, occurrences: list[SongOccurrence]
+    conn: psycopg2.extensions.connection, occurrences: Iterable[SongOccurrence]
 ):
     """
     Insert song occurrences into the database with upsert functionality.
@@ -198,29 +304,35 @@ def insert_song_occurrences_to_db(
     identifiers as lowercase by default. Since our table uses camelCase column names
     ("songId", "liveRecordingArchiveId"), we must quote them to preserve the exact case.
     """
+    rows = list(map(_occurrence_row, occurrences))
+
     with conn.cursor() as cursor:
-        # Split the occurrences into chunks of 50 to avoid db error
-        for chunk in [occurrences[i : i + 50] for i in range(0, len(occurrences), 50)]:
+        if len(rows) >= COPY_THRESHOLD:
+            # See insert_archives_to_db
+            _copy_to_staging(cursor, "SongOccurrenceInLive", OCCURRENCE_INSERT_COLUMNS, rows)
+            cursor.execute(
+                """
+                INSERT INTO "SongOccurrenceInLive" ("songId", "vtuberSongId", "liveRecordingArchiveId", "start", "page")
+                SELECT * FROM "SongOccurrenceInLiveStaging"
+                ON CONFLICT ("vtuberSongId", "liveRecordingArchiveId") DO UPDATE SET
+                    "start" = EXCLUDED."start",
+                    "page" = EXCLUDED."page";
+                """
+            )
+        else:
+            # execute_values sends the rows in statements of page_size rows each
             execute_values(
                 cursor,
                 """
-            INSERT INTO "SongOccurrenceInLive" ("songId", "vtuberSongId", "liveRecordingArchiveId", "start", "page") VALUES %s
-            ON CONFLICT ("vtuberSongId", "liveRecordingArchiveId") DO UPDATE SET
-                "start" = EXCLUDED."start",
-                "page" = EXCLUDED."page";
-            """,
-                [
-                    (
-                        occurrence.song_id,
-                        occurrence.vtuber_song_id,
-                        occurrence.archive_id,
-                        occurrence.start,
-                        occurrence.page,
-                    )
-                    for occurrence in chunk
-                ],
+                INSERT INTO "SongOccurrenceInLive" ("songId", "vtuberSongId", "liveRecordingArchiveId", "start", "page") VALUES %s
+                ON CONFLICT ("vtuberSongId", "liveRecordingArchiveId") DO UPDATE SET
+                    "start" = EXCLUDED."start",
+                    "page" = EXCLUDED."page";
+                """,
+                rows,
+                page_size=500,
             )
-            conn.commit()
+        conn.commit()
 
 def update_recording_transcript_and_mark_scanned(conn: psycopg2.extensions.connection, updates: list[dict]) -> int:
     """
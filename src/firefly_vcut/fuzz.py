@@ -1,6 +1,54 @@
-from rapidfuzz import fuzz
+import numpy as np
+from rapidfuzz import fuzz, process
 
-def search_text_in_transcript(transcript: list[list[dict]], text: str) -> tuple[int, int, int, str] | None:
+
+class PreprocessedTranscript:
+    """
+    A transcript together with the segment texts search_text_in_transcript compares
+    against. The same transcript is searched for every song, so the joined texts are
+    built once per transcript (and window size) rather than once per search.
+    """
+
+    def __init__(self, transcript: list[list[dict]]):
+        self.transcript = transcript
+        # The texts and starts of the segments of each page, pulled out of the segment
+        # dicts once and shared by the windows of every size
+        self._texts = [[sg["text"] for sg in segment] for segment in transcript]
+        self._starts = [[sg["start"] for sg in segment] for segment in transcript]
+        # The text of each page, segments joined with newlines
+        self.pages = ["\n".join(texts) for texts in self._texts]
+        # window size -> for each page, (start, text) of each window of that many segments
+        self._windows: dict[int, list[list[tuple[float, str]]]] = {}
+
+    def windows(self, size: int) -> list[list[tuple[float, str]]]:
+        """
+        Get the windows of `size` consecutive segments of each page, as (start, text).
+        A page with fewer segments than that is a single window.
+        """
+        if size not in self._windows:
+            pages = []
+            for texts, starts, page_text in zip(self._texts, self._starts, self.pages):
+                if len(texts) < size:
+                    pages.append([(starts[0], page_text)] if texts else [])
+                    continue
+                pages.append(
+                    [
+                        (starts[i], "\n".join(texts[i : i + size]))
+                        for i in range(len(texts) - size + 1)
+                    ]
+                )
+            self._windows[size] = pages
+        return self._windows[size]
+
+
+def preprocess_transcript(transcript: list[list[dict]]) -> PreprocessedTranscript:
+    """
+    Prepare a transcript to be searched for many texts, see search_preprocessed.
+    """
+    return PreprocessedTranscript(transcript)
+
+
+def search_text_in_transcript(transcript: list[list[dict]], text: str) -> tuple[float, int, float, str] | None:
     """
     Search for the given text in the transcript.
 
@@ -9,37 +57,101 @@ def search_text_in_transcript(transcript: list[list[dict]], text: str) -> tuple[
         text: The text to search for
 
     Returns:
-        tuple[int, int, int, str] | None: The start time, page, similarity score, and text of the text
+        tuple[float, int, float, str] | None: The start time, page, similarity score, and text of the text
         in the transcript with the highest similarity score
     """
+    return search_preprocessed(preprocess_transcript(transcript), text)
+
 
-    max_score = 0
-    max_page = None
-    max_segment_start = None
-    max_segment_text = None
+def search_preprocessed(transcript: PreprocessedTranscript, text: str) -> tuple[float, int, float, str] | None:
+    """
+    Search for the given text in a preprocessed transcript, see search_text_in_transcript.
+    """
+    return search_many_preprocessed(transcript, [text])[0]
 
-    num_segment_in_text = len(text.split("\n"))
 
-    for page, segment in enumerate(transcript):
-        if len(segment) < num_segment_in_text:
-            segment_text = "\n".join([sg["text"] for sg in segment])
-            score = fuzz.ratio(text, segment_text)
-            if max_page is None or score > max_score:
-                max_score = score
-                max_page = page
-                max_segment_text = segment_text
-                max_segment_start = segment[0]["start"]
+def search_many_preprocessed(
+    transcript: PreprocessedTranscript, texts: list[str], score_cutoff: float = 0
+) -> list[tuple[float, int, float, str] | None]:
+    """
+    Search for many texts in a preprocessed transcript at once. The texts are scored
+    against all the windows of the transcript in one multithreaded rapidfuzz call per
+    window size, and the first of the best scoring windows wins.
+
+    Args:
+        transcript: The transcript to search in
+        texts: The texts to search for
+        score_cutoff: The lowest score of interest, texts that don't reach it in any window
+            get None. rapidfuzz stops scoring a window as soon as it can't reach the cutoff.
+
+    Returns:
+        list[tuple[float, int, float, str] | None]: The result of each text, see search_text_in_transcript
+    """
+    results = [None] * len(texts)
+
+    # Texts with the same number of lines are compared against the same windows
+    by_size: dict[int, list[int]] = {}
+    for i, text in enumerate(texts):
+        by_size.setdefault(text.count("\n") + 1, []).append(i)
+
+    for size, indices in by_size.items():
+        # All the windows of all the pages, in page order
+        pages = []
+        starts = []
+        choices = []
+        for page, windows in enumerate(transcript.windows(size)):
+            for start, segment_text in windows:
+                pages.append(page)
+                starts.append(start)
+                choices.append(segment_text)
+
+        if not choices:
             continue
 
-        for i in range(len(segment) - num_segment_in_text + 1):
-            segment_text = "\n".join([sg["text"] for sg in segment[i : i + num_segment_in_text]])
-            score = fuzz.ratio(text, segment_text)
-            if max_page is None or score > max_score:
-                max_score = score
-                max_page = page
-                max_segment_text = segment_text
-                max_segment_start = segment[i]["start"]
-    
-    return (max_segment_start, max_page+1, max_score, max_segment_text)
-    
-    
\ No newline at end of file
+        scores = process.cdist(
+            [texts[i] for i in indices],
+            choices,
+            scorer=fuzz.ratio,
+            dtype=np.float64,
+            workers=-1,
+            score_cutoff=score_cutoff,
+        )
+        for i, row in zip(indices, scores):
+            # argmax picks the first of equally good windows
+            best = int(row.argmax())
+            # Scores below the cutoff come back as 0
+            if row[best] < score_cutoff:
+                continue
+            results[i] = (starts[best], pages[best] + 1, float(row[best]), choices[best])
+
+    return results
+
+
+def find_exact_text_in_transcript(
+    transcript: PreprocessedTranscript, text: str
+) -> tuple[float, int, float, str] | None:
+    """
+    Look for segments of the transcript that are exactly the given text. This is what
+    search_text_in_transcript returns when such segments exist, with a score of 100, at
+    the cost of a substring search instead of scoring every window of segments.
+
+    Args:
+        transcript: The transcript to search in
+        text: The text to search for
+
+    Returns:
+        tuple[float, int, float, str] | None: The start time, page, similarity score, and text
+        of the first exact match, or None if there is no exact match
+    """
+    for page, joined in enumerate(transcript.pages):
+        pos = joined.find(text)
+        while pos != -1:
+            end = pos + len(text)
+            # The match has to line up with segment boundaries to be a window of segments
+            if (pos == 0 or joined[pos - 1] == "\n") and (
+                end == len(joined) or joined[end] == "\n"
+            ):
+                i = joined.count("\n", 0, pos)
+                return (transcript.transcript[page][i]["start"], page + 1, 100, text)
+            pos = joined.find(text, pos + 1)
+    return None
@@ -1,8 +1,77 @@
+import contextlib
 import os
-import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from .app import app, bucket_volume, BUCKET_DIR, secret
 
+# Number of transcripts read ahead of the one being searched. The bucket is mounted
+# over the network, so reads are slow relative to parsing and searching.
+PREFETCH_TRANSCRIPTS = 2
+
+# Number of recordings whose occurrences are written to the database together.
+FLUSH_RECORDINGS = 16
+
+# Lowest similarity score of a lyrics fragment in a transcript to count as an occurrence.
+MIN_SCORE = 40
+
+# CPU cores of populate_occurrences. Scoring runs on all of them (cdist workers=-1),
+# and the default fraction of a core leaves the multithreaded scorer with nothing to use.
+SCORING_CPU = 8.0
+
+
+def read_transcript(transcript_object_key: str) -> list[list[dict]]:
+    """
+    Read and parse a transcript from the bucket.
+    """
+    import orjson
+
+    with open(os.path.join(BUCKET_DIR, transcript_object_key), "rb") as f:
+        return orjson.loads(f.read())
+
+
+def save_occurrences(conn, occurrences: list[dict], recording_ids: list[int]):
+    """
+    Write the occurrences found in the given recordings and mark the recordings as
+    scanned, in one pipelined transaction.
+    """
+    import firefly_vcut.db as db
+
+    # Large batches are COPYed, which can't be pipelined
+    if len(occurrences) >= db.occurrence.COPY_THRESHOLD:
+        pipeline = contextlib.nullcontext()
+    else:
+        pipeline = conn.pipeline()
+    with pipeline:
+        db.occurrence.create_occurrences(conn, occurrences, commit=False)
+        db.recording.mark_recordings_scanned(conn, recording_ids, commit=False)
+    conn.commit()
+
+
+def iter_transcripts(recordings: list[dict]):
+    """
+    Yield (recording, transcript) for each recording in order, reading the following
+    transcripts in the background while the caller works on the current one.
+    """
+    recordings = iter(recordings)
+    with ThreadPoolExecutor(max_workers=PREFETCH_TRANSCRIPTS) as executor:
+        pending = deque()
+
+        def submit():
+            recording = next(recordings, None)
+            if recording is not None:
+                pending.append(
+                    (recording, executor.submit(read_transcript, recording["transcriptObjectKey"]))
+                )
+
+        for _ in range(PREFETCH_TRANSCRIPTS):
+            submit()
+        while pending:
+            recording, future = pending.popleft()
+            submit()
+            yield recording, future.result()
+
+
 @app.function(
     timeout=30 * 60,  # 30 minutes
     secrets=[secret],
@@ -12,7 +81,7 @@ from .app import app, bucket_volume, BUCKET_DIR, secret
 )
 def backfill_occurrences(song_title: str, backfill_limit: int = 10):
     import firefly_vcut.db as db
-    from firefly_vcut.fuzz import search_text_in_transcript
+    from firefly_vcut.fuzz import preprocess_transcript, search_many_preprocessed
 
     with db.connection(os.getenv("DATABASE_URL")) as conn:
         songs = db.song.list_songs_by_title(conn, song_title)
@@ -25,35 +94,31 @@ def backfill_occurrences(song_title: str, backfill_limit: int = 10):
             return
 
     occurrences = []
-    for recording in recordings:
+    for recording, transcript in iter_transcripts(recordings):
         print(f"Backfilling occurrences for {recording['bvid']}")
-        transcript_object_key = recording["transcriptObjectKey"]
-        transcript_path = os.path.join(BUCKET_DIR, transcript_object_key)
-        with open(transcript_path, "r") as f:
-            transcript = json.load(f)
+        transcript = preprocess_transcript(transcript)
 
-        for song in songs:
-            entry = search_text_in_transcript(transcript, song["lyrics_fragment"])
+        entries = search_many_preprocessed(
+            transcript, [song["lyrics_fragment"] for song in songs], score_cutoff=MIN_SCORE
+        )
+        for song, entry in zip(songs, entries):
             if entry is None:
                 continue
 
             start, page, score, text = entry
-            if score < 40:
-                continue
             print(
                 f"Found {song['title']} in {recording['bvid']} at page {page} at {start} with score {score}"
             )
             print(f"Matched text: {text}")
 
-            for i, vtuber_song_id in enumerate(song["vtuber_song_ids"]):
-                vtuber_profile_id = song["vtuber_profile_ids"][i]
-                if vtuber_profile_id != recording["vtuber_profile_id"]:
+            for vtuber_song in song["vtuber_songs"]:
+                if vtuber_song["vtuber_profile_id"] != recording["vtuber_profile_id"]:
                     continue
 
                 occurrences.append(
                     {
                         "song_id": song["id"],
-                        "vtuber_song_id": vtuber_song_id,
+                        "vtuber_song_id": vtuber_song["vtuber_song_id"],
                         "archive_id": recording["id"],
                         "start": start,
                         "page": page,
@@ -63,13 +128,12 @@ def backfill_occurrences(song_title: str, backfill_limit: int = 10):
         print(f"Found {len(occurrences)} occurrences for {recording['bvid']}")
 
     with db.connection(os.getenv("DATABASE_URL")) as conn:
-        db.occurrence.create_occurrences(conn, occurrences)
-        for recording in recordings:
-            db.recording.mark_recording_scanned(conn, recording["id"])
+        save_occurrences(conn, occurrences, [recording["id"] for recording in recordings])
 
 
 @app.function(
     timeout=30 * 60,  # 30 minutes
+    cpu=SCORING_CPU,
     secrets=[secret],
     volumes={
         BUCKET_DIR: bucket_volume,
@@ -77,7 +141,7 @@ def backfill_occurrences(song_title: str, backfill_limit: int = 10):
 )
 def populate_occurrences():
     import firefly_vcut.db as db
-    from firefly_vcut.fuzz import search_text_in_transcript
+    from firefly_vcut.fuzz import preprocess_transcript, search_many_preprocessed
 
     with db.connection(os.getenv("DATABASE_URL")) as conn:
         recordings = db.recording.list_recordings_to_populate_occurrences(conn)
@@ -85,46 +149,52 @@ def populate_occurrences():
             print("No recordings to populate occurrences")
             return
 
-        songs = db.song.list_all_songs_with_vtuber_song_ids(conn)
-
-    for recording in recordings:
-        print(f"Populating occurrences for {recording['bvid']}")
+        # Only the songs of the vtubers whose recordings we are about to search
+        songs_by_vtuber = {
+            vtuber_profile_id: db.song.list_songs_by_vtuber_profile_id(conn, vtuber_profile_id)
+            for vtuber_profile_id in {recording["vtuber_profile_id"] for recording in recordings}
+        }
+        conn.commit()
 
+        # Occurrences and recordings not written to the database yet
         occurrences = []
-        transcript_object_key = recording["transcriptObjectKey"]
-        transcript_path = os.path.join(BUCKET_DIR, transcript_object_key)
-        with open(transcript_path, "r") as f:
-            transcript = json.load(f)
+        scanned = []
+        for recording, transcript in iter_transcripts(recordings):
+            print(f"Populating occurrences for {recording['bvid']}")
 
-        for song in songs:
-            entry = search_text_in_transcript(transcript, song["lyrics_fragment"])
-            if entry is None:
-                continue
+            found_before = len(occurrences)
+            transcript = preprocess_transcript(transcript)
+            songs = songs_by_vtuber[recording["vtuber_profile_id"]]
 
-            start, page, score, text = entry
-            if score < 40:
-                continue
-            print(
-                f"Found {song['title']} in {recording['bvid']} at page {page} at {start} with score {score}"
+            entries = search_many_preprocessed(
+                transcript, [song["lyrics_fragment"] for song in songs], score_cutoff=MIN_SCORE
             )
-            print(f"Matched text: {text}")
-
-            for i, vtuber_song_id in enumerate(song["vtuber_song_ids"]):
-                vtuber_profile_id = song["vtuber_profile_ids"][i]
-                if vtuber_profile_id != recording["vtuber_profile_id"]:
+            for song, entry in zip(songs, entries):
+                if entry is None:
                     continue
 
+                start, page, score, text = entry
+                print(
+                    f"Found {song['title']} in {recording['bvid']} at page {page} at {start} with score {score}"
+                )
+                print(f"Matched text: {text}")
+
                 occurrences.append(
                     {
                         "song_id": song["id"],
-                        "vtuber_song_id": vtuber_song_id,
+                        "vtuber_song_id": song["vtuber_song_id"],
                         "archive_id": recording["id"],
                         "start": start,
                         "page": page,
                     }
                 )
 
-        print(f"Found {len(occurrences)} occurrences for {recording['bvid']}")
-        with db.connection(os.getenv("DATABASE_URL")) as conn:
-            db.occurrence.create_occurrences(conn, occurrences)
-            db.recording.mark_recording_scanned(conn, recording["id"])
+            print(f"Found {len(occurrences) - found_before} occurrences for {recording['bvid']}")
+            scanned.append(recording["id"])
+            if len(scanned) == FLUSH_RECORDINGS:
+                save_occurrences(conn, occurrences, scanned)
+                occurrences = []
+                scanned = []
+
+        if scanned:
+            save_occurrences(conn, occurrences, scanned)
@@ -18,7 +18,8 @@ def discover_new_recordings() -> int:
     # - newer than the latest recording
     # subject to the limit of number of recordings for each vtuber
 
-    new_recordings = 0
+    # mid -> the new archives of the vtuber, written together at the end
+    new_archives = {}
     for entry in entries:
         mid = entry["mid"]
         last_pubdate = entry["latest_pubdate"]
@@ -47,13 +48,22 @@ def discover_new_recordings() -> int:
         for archive in archives:
             print(f"Inserting new archive {archive['bvid']} {archive['title']}, pubdate {archive['pubdate']}")
             archive["cover"] = archive.pop("pic")
-        
-        with db.connection(os.getenv("DATABASE_URL")) as conn:
-            db.recording.create_recordings(conn, archives, mid)
-        
-        print(f"Created {len(archives)} new recordings for vtuber {mid}")
-        new_recordings += len(archives)
-    
+
+        new_archives[mid] = archives
+
+    if not new_archives:
+        return 0
+
+    new_recordings = 0
+    with db.connection(os.getenv("DATABASE_URL")) as conn:
+        # Queue the inserts of all vtubers in one pipeline and commit them together.
+        with conn.pipeline():
+            for mid, archives in new_archives.items():
+                db.recording.create_recordings(conn, archives, mid, commit=False)
+                print(f"Created {len(archives)} new recordings for vtuber {mid}")
+                new_recordings += len(archives)
+        conn.commit()
+
     return new_recordings
 
 
@@ -1,21 +1,56 @@
 import asyncio
+from collections.abc import AsyncIterator
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import functools
 import os
-import time
 
 import aiohttp
 import botocore
+import botocore.config
 import pytz
-import requests
 import firefly_vcut.db as db
 import boto3
 from firefly_vcut import bilibili
-from firefly_vcut.retry import retry_with_backoff, retry_with_backoff_async
+from firefly_vcut.retry import retry_with_backoff_async
 from firefly_vcut.config import STREAMING_RETRY_CONFIG
 
 from .app import app, secret
 
+SHANGHAI_TZ = pytz.timezone("Asia/Shanghai")
+
+# Number of chunks of a page downloaded and uploaded at the same time. Together with
+# PAGE_CONCURRENCY this bounds both the bandwidth in use and the chunks buffered in memory.
+CHUNK_CONCURRENCY = 8
+
+# Number of pages of a recording streamed at the same time.
+PAGE_CONCURRENCY = 2
+
+# Size of the pieces a chunk is read in as it arrives.
+READ_PIECE_SIZE = 1024 * 1024
+
+# Seconds to wait before retrying a page's upload with the next chunk size.
+FALLBACK_DELAY = 10
+
+AUDIO_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
+
+
+def create_stream_session() -> aiohttp.ClientSession:
+    """
+    Create the aiohttp session all the requests of stream_recordings go through: the
+    video info and stream url lookups, the HEAD requests for the audio size and the
+    chunk downloads.
+    Connections to bilibili and its CDN are kept alive across chunks and pages instead
+    of handshaking for every request.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=4 * CHUNK_CONCURRENCY,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        ),
+    )
+
 
 @app.function(
     timeout=60 * 60,  # 60 minutes
@@ -37,40 +72,77 @@ async def stream_recordings():
         endpoint_url=os.getenv("R2_ENDPOINT"),
         aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
         aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        # One pooled connection for every thread that may be calling R2 at once (see
+        # stream_recording), the default pool of 10 would make the rest wait.
+        config=botocore.config.Config(
+            max_pool_connections=PAGE_CONCURRENCY * (CHUNK_CONCURRENCY + 1),
+            tcp_keepalive=True,
+        ),
     )
 
-    for recording in recordings:
-        print(f"Streaming recording {recording['title']} ({recording['bvid']})...")
+    async with create_stream_session() as session:
+        # Video info lookups are independent of each other, fetch them all up front
+        # instead of one round trip per recording.
+        infos = await bilibili.video_async.batch_get_video_infos(
+            [recording["bvid"] for recording in recordings], sessdata, session
+        )
 
-        try:
-            object_keys = await stream_recording(
-                recording,
-                sessdata,
-                wbi_key,
-                r2,
-                os.getenv("R2_BUCKET"),
+        for recording in recordings:
+            await stream_and_save_recording(
+                session, recording, infos[recording["bvid"]], sessdata, wbi_key, r2
             )
 
-            print(
-                f"Streamed audio from recording {recording['title']} to {object_keys} in bucket {os.getenv('R2_BUCKET')}"
-            )
 
-            # Update the recording with the object keys
-            with db.connection(os.getenv("DATABASE_URL")) as conn:
-                db.recording.update_recording_audio_object_keys(
-                    conn, recording["id"], object_keys
-                )
+async def stream_and_save_recording(
+    session: aiohttp.ClientSession,
+    recording: dict,
+    info_response: dict | BaseException,
+    sessdata: str,
+    wbi_key: tuple[str, str],
+    r2: botocore.client.BaseClient,
+):
+    """
+    Stream the audio of a recording and record its object keys in the database. Failures
+    are logged rather than raised so that the remaining recordings still get streamed.
+    """
+    print(f"Streaming recording {recording['title']} ({recording['bvid']})...")
 
-                print(
-                    f"Updated recording {recording['title']} with object keys {object_keys} in database"
-                )
-        except Exception as e:
-            print(f"Failed to stream recording {recording['title']}: {e}")
-            continue
+    if isinstance(info_response, BaseException):
+        print(f"Failed to get video info of {recording['title']}: {info_response}")
+        return
+
+    try:
+        object_keys = await stream_recording(
+            session,
+            recording,
+            info_response,
+            sessdata,
+            wbi_key,
+            r2,
+            os.getenv("R2_BUCKET"),
+        )
+
+        print(
+            f"Streamed audio from recording {recording['title']} to {object_keys} in bucket {os.getenv('R2_BUCKET')}"
+        )
+
+        # Update the recording with the object keys
+        with db.connection(os.getenv("DATABASE_URL")) as conn:
+            db.recording.update_recording_audio_object_keys(
+                conn, recording["id"], object_keys
+            )
+
+            print(
+                f"Updated recording {recording['title']} with object keys {object_keys} in database"
+            )
+    except Exception as e:
+        print(f"Failed to stream recording {recording['title']}: {e}")
 
 
 async def stream_recording(
+    session: aiohttp.ClientSession,
     recording: dict,
+    info_response: dict,
     sessdata: str,
     wbi_key: tuple[str, str],
     r2: botocore.client.BaseClient,
@@ -80,10 +152,12 @@ async def stream_recording(
     Stream audio for a recording and save it to object store.
 
     Args:
+        session: The aiohttp session to issue the requests with, see create_stream_session.
         recording: A dictionary with the following keys:
             - id: The recording ID.
             - title: The title of the recording.
             - bvid: The Bilibili video ID.
+        info_response: The video info response of the recording, see bilibili.video.get_video_info.
         sessdata: The sessdata of the user.
         wbi_key: The wbi key of the user.
         r2: s3 client for the cloudflare r2 bucket
@@ -93,27 +167,59 @@ async def stream_recording(
         A list of object keys for the streamed audio
     """
 
-    # Get the video info
-    info_response = bilibili.video.get_video_info(
-        recording["bvid"], os.getenv("BILIBILI_SESSDATA")
-    )
     if info_response["code"] != 0:
         raise Exception(f"Failed to get video info: {info_response['message']}")
 
     if not info_response["data"]["pages"]:
         raise Exception(f"No pages found for video {recording['bvid']}")
 
-    object_keys = []
-    for page in info_response["data"]["pages"]:
+    # boto3 is synchronous, every R2 call runs on this pool so that none of them blocks
+    # the event loop while the chunks of another page are downloading. One thread per
+    # part that may be uploading, plus one per page for creating and completing uploads.
+    executor = ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY * (CHUNK_CONCURRENCY + 1))
+    try:
+        return await _stream_recording(
+            session, recording, info_response, sessdata, wbi_key, r2, bucket, executor
+        )
+    finally:
+        # Every page has finished by now. Don't block the loop on uploads of cancelled
+        # chunks that are still wrapping up.
+        executor.shutdown(wait=False)
+
+
+async def _stream_recording(
+    session: aiohttp.ClientSession,
+    recording: dict,
+    info_response: dict,
+    sessdata: str,
+    wbi_key: tuple[str, str],
+    r2: botocore.client.BaseClient,
+    bucket: str,
+    executor: ThreadPoolExecutor,
+) -> list[str]:
+    loop = asyncio.get_running_loop()
+
+    def run_blocking(func, *args, **kwargs):
+        return loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    # The pages of a recording share a prefix, list what's there once instead of
+    # probing each page's object.
+    prefix = get_audio_object_key(recording, 1).rsplit("/", 1)[0] + "/"
+    existing_keys = await run_blocking(list_object_keys, r2, bucket, prefix)
+
+    # The same for every request for the recording's audio, only chunks add a Range
+    headers = audio_headers(sessdata)
+
+    async def stream_page(page: dict) -> str:
         audio_object_key = get_audio_object_key(recording, page["page"])
         print(f"Streaming page {page['page']} to {audio_object_key}...")
 
-        if object_exists(r2, bucket, audio_object_key):
+        if audio_object_key in existing_keys:
             print(f"Audio object {audio_object_key} already exists, skipping...")
-            object_keys.append(audio_object_key)
-            continue
+            return audio_object_key
 
-        stream_url_response = bilibili.video.get_video_stream_url(
+        stream_url_response = await bilibili.video_async.get_video_stream_url_async(
+            session,
             recording["bvid"],
             page["cid"],
             4048,  # Dash audio.
@@ -131,22 +237,16 @@ async def stream_recording(
         audio_url = selected_audio["baseUrl"]
 
         # Get the content length of the audio by sending a HEAD request
-        def _make_head_request():
-            audio_resp = requests.head(
-                audio_url,
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
-                    "Cookie": f"SESSDATA={sessdata}",
-                    "Referer": "https://www.bilibili.com/",
-                },
-            )
-            return audio_resp
+        async def _make_head_request():
+            async with session.head(audio_url, headers=headers) as audio_resp:
+                # The headers stay readable once the connection is released
+                return audio_resp
 
-        audio_resp = retry_with_backoff(_make_head_request, STREAMING_RETRY_CONFIG)
+        audio_resp = await retry_with_backoff_async(_make_head_request, STREAMING_RETRY_CONFIG)
 
-        if audio_resp.status_code != 200:
+        if audio_resp.status != 200:
             raise Exception(
-                f"Failed to get audio content length: {audio_resp.status_code}"
+                f"Failed to get audio content length: {audio_resp.status}"
             )
 
         content_length = int(audio_resp.headers["Content-Length"])
@@ -158,14 +258,21 @@ async def stream_recording(
             # closes the connection for a specific chunk.
             # This manifests as <ContentLengthError: 400, message='Not enough data to satisfy content length header.'>
             # when reading the chunk.
+            # A chunk whose connection drops first resumes from the bytes it already
+            # has, the next chunk size is only tried once a chunk runs out of retries.
 
             print(f"Chunking audio with chunk size {chunk_size}...")
             chunks = chunk_audio(content_length, chunk_size)
 
+            upload_id = None
+            tasks = []
             try:
                 # Start multipart upload
-                multipart_upload = r2.create_multipart_upload(
-                    Bucket=bucket, Key=audio_object_key, ContentType="audio/mp4"
+                multipart_upload = await run_blocking(
+                    r2.create_multipart_upload,
+                    Bucket=bucket,
+                    Key=audio_object_key,
+                    ContentType="audio/mp4",
                 )
                 upload_id = multipart_upload["UploadId"]
                 print(
@@ -175,78 +282,83 @@ async def stream_recording(
                 async def upload_single_chunk(
                     part_number: int,
                     chunk: tuple[int, int],
-                    thread_pool_executor: ThreadPoolExecutor,
+                    semaphore: asyncio.Semaphore,
                 ) -> dict:
-                    range_header = (
-                        f"bytes={chunk[0]}-{chunk[1]}"
-                        if chunk[1] != -1
-                        else f"bytes={chunk[0]}-"
-                    )
+                    async with semaphore:
+                        return await _upload_single_chunk(part_number, chunk)
 
-                    header = {
-                        "Cookie": f"SESSDATA={sessdata}",
-                        "Referer": "https://www.bilibili.com/",
-                        "User-Agent": "Mozilla/5.0",
-                        "Range": range_header,
-                    }
+                async def _upload_single_chunk(
+                    part_number: int,
+                    chunk: tuple[int, int],
+                ) -> dict:
+                    chunk_data = bytearray(chunk[1] - chunk[0] + 1)
+                    view = memoryview(chunk_data)
+                    # Bytes of the chunk received so far. A retry only asks for the rest
+                    # of the chunk instead of starting it over.
+                    received = 0
 
                     async def _make_async_request():
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(audio_url, headers=header) as resp:
-                                if not resp.ok:
-                                    raise Exception(
-                                        f"Failed to get audio chunk: {resp.status}, {await resp.text()}"
-                                    )
-
-                                # Check if Content-Length matches what we expect
-                                content_length = resp.headers.get("Content-Length")
-                                expected_size = (
-                                    chunk[1] - chunk[0] + 1 if chunk[1] != -1 else None
+                        nonlocal received
+                        header = {
+                            **headers,
+                            "Range": f"bytes={chunk[0] + received}-{chunk[1]}",
+                        }
+                        async with session.get(audio_url, headers=header) as resp:
+                            if not resp.ok:
+                                raise Exception(
+                                    f"Failed to get audio chunk: {resp.status}, {await resp.text()}"
                                 )
 
-                                if content_length and expected_size:
-                                    if int(content_length) != expected_size:
-                                        print(
-                                            f"Warning: Content-Length mismatch. Expected: {expected_size}, Got: {content_length}"
-                                        )
-                                        raise Exception(
-                                            f"Content-Length mismatch. Expected: {expected_size}, Got: {content_length}"
-                                        )
+                            # Check if Content-Length matches what we expect
+                            content_length = resp.headers.get("Content-Length")
+                            expected_size = len(chunk_data) - received
+
+                            if content_length:
+                                if int(content_length) != expected_size:
+                                    print(
+                                        f"Warning: Content-Length mismatch. Expected: {expected_size}, Got: {content_length}"
+                                    )
+                                    raise Exception(
+                                        f"Content-Length mismatch. Expected: {expected_size}, Got: {content_length}"
+                                    )
+                            if received:
+                                print(f"Resuming chunk {chunk} at {received} bytes...")
+                            else:
                                 print(f"Reading chunk {chunk}...")
-                                # Note: let's see how it works just buffering the whole thing in memory so I don't have
-                                # to deal with the fancy streaming and buffering to save some memory. One page is typically
-                                # 200-500MB, and the cost of that is pretty much negligible compared to GPU (my guess).
-                                return await resp.read()
+                            start = received
+                            async for read in read_into(resp, view[start:]):
+                                received = start + read
 
-                    chunk_data = await retry_with_backoff_async(
+                    await retry_with_backoff_async(
                         _make_async_request, STREAMING_RETRY_CONFIG
                     )
 
                     print(f"Uploading chunk {chunk}...")
-                    loop = asyncio.get_event_loop()
-                    upload_response = await loop.run_in_executor(
-                        thread_pool_executor,
-                        lambda: r2.upload_part(
-                            Bucket=bucket,
-                            Key=audio_object_key,
-                            PartNumber=part_number,
-                            UploadId=upload_id,
-                            Body=chunk_data,
-                            ContentLength=len(chunk_data),
-                        ),
+                    upload_response = await run_blocking(
+                        r2.upload_part,
+                        Bucket=bucket,
+                        Key=audio_object_key,
+                        PartNumber=part_number,
+                        UploadId=upload_id,
+                        Body=chunk_data,
+                        ContentLength=len(chunk_data),
                     )
 
                     print(f"Uploaded chunk {chunk}...")
                     return {"ETag": upload_response["ETag"], "PartNumber": part_number}
 
-                with ThreadPoolExecutor(max_workers=5) as thread_pool_executor:
-                    tasks = [
-                        upload_single_chunk(i + 1, chunk, thread_pool_executor)
-                        for i, chunk in enumerate(chunks)
-                    ]
-                    results = await asyncio.gather(*tasks)
+                # Every chunk holding the semaphore may be uploading at once
+                semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+                # Tasks rather than bare coroutines, so the chunks still running when
+                # one fails can be cancelled
+                tasks = [
+                    asyncio.ensure_future(upload_single_chunk(i + 1, chunk, semaphore))
+                    for i, chunk in enumerate(chunks)
+                ]
+                results = await asyncio.gather(*tasks)
                 # Complete multipart upload
-                r2.complete_multipart_upload(
+                await run_blocking(
+                    r2.complete_multipart_upload,
                     Bucket=bucket,
                     Key=audio_object_key,
                     UploadId=upload_id,
@@ -263,55 +375,107 @@ async def stream_recording(
                 print(
                     f"Failed to complete multipart upload: {e}, try another chunk size..."
                 )
-                if tasks:
-                    for task in tasks:
-                        task.cancel()
+                for task in tasks:
+                    task.cancel()
 
                 if upload_id:
-                    r2.abort_multipart_upload(
-                        Bucket=bucket, Key=audio_object_key, UploadId=upload_id
+                    await run_blocking(
+                        r2.abort_multipart_upload,
+                        Bucket=bucket,
+                        Key=audio_object_key,
+                        UploadId=upload_id,
                     )
-                time.sleep(10)
+                # Give bilibili a moment without blocking the event loop
+                await asyncio.sleep(FALLBACK_DELAY)
 
-        object_keys.append(audio_object_key)
+        return audio_object_key
 
-    return object_keys
+    # Stream a few pages at once, each of them in up to CHUNK_CONCURRENCY chunks
+    semaphore = asyncio.Semaphore(PAGE_CONCURRENCY)
 
+    async def stream_page_limited(page: dict) -> str:
+        async with semaphore:
+            return await stream_page(page)
 
-def object_exists(
+    # Let every page finish before failing the recording, so that none is left
+    # uploading in the background
+    results = await asyncio.gather(
+        *[stream_page_limited(page) for page in info_response["data"]["pages"]],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    # In page order, as gather keeps the order of its arguments
+    return results
+
+
+async def read_into(resp: aiohttp.ClientResponse, buffer: memoryview) -> AsyncIterator[int]:
+    """
+    Read a response body into a buffer of its expected size, piece by piece as it
+    arrives, yielding the number of bytes read so far after each piece. The caller
+    knows how far the body got even if the connection drops halfway through, while
+    resp.read() would lose everything read so far and hold the body in memory twice.
+    """
+    size = len(buffer)
+    offset = 0
+    async for piece in resp.content.iter_chunked(READ_PIECE_SIZE):
+        if offset + len(piece) > size:
+            raise Exception(f"Response body is larger than its expected size {size}")
+        buffer[offset : offset + len(piece)] = piece
+        offset += len(piece)
+        yield offset
+    if offset != size:
+        raise Exception(f"Response body ended at {offset} of its expected size {size}")
+
+
+def audio_headers(sessdata: str) -> dict:
+    """
+    Headers for requesting audio from bilibili's CDN on behalf of the login user.
+    Requests without a bilibili Referer are turned away.
+    """
+    return {
+        "User-Agent": AUDIO_USER_AGENT,
+        "Cookie": f"SESSDATA={sessdata}",
+        "Referer": "https://www.bilibili.com/",
+    }
+
+
+def list_object_keys(
     r2: botocore.client.BaseClient,
     bucket: str,
-    object_key: str,
-) -> bool:
+    prefix: str,
+) -> set[str]:
     """
-    Check if the audio object key already exists.
+    List the keys of the objects under the given prefix.
     """
-    try:
-        r2.head_object(Bucket=bucket, Key=object_key)
-        return True
-    except botocore.exceptions.ClientError as e:
-        if e.response["Error"]["Code"] == "404":
-            return False
-        raise e
+    keys = set()
+    for page in r2.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        keys.update(obj["Key"] for obj in page.get("Contents", []))
+    return keys
 
 
 def chunk_audio(
     content_length: int, chunk_size: int | None = 20 * 1024 * 1024
 ) -> list[tuple[int, int]]:
     """
-    Chunk the audio into chunks of the given size.
+    Chunk the audio into chunks of the given size, the last one taking what's left.
+
+    Args:
+        content_length: The size of the audio in bytes.
+        chunk_size: The size of a chunk in bytes, None for a single chunk.
+
+    Returns:
+        The first and last byte of each chunk, inclusive as in an HTTP Range header.
     """
 
     if chunk_size is None:
-        return [(0, -1)]
+        chunk_size = content_length
 
-    chunks = []
-    for i in range(0, content_length, chunk_size + 1):
-        if i + chunk_size >= content_length:
-            chunks.append((i, -1))
-        else:
-            chunks.append((i, i + chunk_size))
-    return chunks
+    return [
+        (i, min(i + chunk_size, content_length) - 1)
+        for i in range(0, content_length, chunk_size)
+    ]
 
 
 def get_audio_object_key(recording: dict, page: int) -> str:
@@ -335,7 +499,7 @@ def get_audio_object_key(recording: dict, page: int) -> str:
     mid = recording["mid"]
     pubdate = recording["pubdate"]
     # Extract year, month, day from pudate in tz Asia/Shanghai
-    pubdate = datetime.fromtimestamp(pubdate, tz=pytz.timezone("Asia/Shanghai"))
+    pubdate = datetime.fromtimestamp(pubdate, tz=SHANGHAI_TZ)
     year = pubdate.year
     month = pubdate.month
     day = pubdate.day
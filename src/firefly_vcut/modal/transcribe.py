@@ -1,19 +1,26 @@
 from datetime import datetime
-import json
 import modal
 import tempfile
 import os
 
 import pathlib
 
+import pytz
+
 from .app import app, cache_volume, bucket_volume, CACHE_DIR, BUCKET_DIR, secret, image
 
+SHANGHAI_TZ = pytz.timezone("Asia/Shanghai")
+
 @app.cls(
     gpu="T4",
     image=image,
     timeout=60 * 60, # 60 minutes
+    # Keep an idle container, and the model loaded on its GPU, around between the
+    # recordings of a run instead of loading the model again for the next one.
+    scaledown_window=5 * 60, # 5 minutes
     volumes={
         CACHE_DIR: cache_volume,
+        BUCKET_DIR: bucket_volume,
     },
 )
 class Whisper:
@@ -22,9 +29,18 @@ class Whisper:
     @modal.enter()
     def setup(self):
         print("🔄 Loading Whisper model …")
+        import numpy as np
+        import torch
         import whisper
 
+        # Whisper always feeds 30 second windows of the same shape, so the fastest
+        # cuDNN algorithms found on the first window hold for all the others
+        torch.backends.cudnn.benchmark = True
         self.model = whisper.load_model("turbo", download_root=CACHE_DIR)
+
+        # Warm up the GPU (CUDA context, kernel selection) on a second of silence here,
+        # rather than in the first page we are asked to transcribe
+        self.model.transcribe(np.zeros(16000, dtype=np.float32), language="zh", fp16=True)
         print("✅ Model ready!")
 
     @modal.method()
@@ -36,17 +52,31 @@ class Whisper:
             temp_audio_path = f.name
 
         try:
-            result = self.model.transcribe(temp_audio_path, language="zh", verbose=True)
-            segments = [
-                {"start": segment["start"], "text": segment["text"]}
-                for segment in result["segments"]
-            ]
-
-            print(f"✅ Transcribed {len(segments)} segments")
-            return segments
+            return self._transcribe_path(temp_audio_path)
         finally:
             os.unlink(temp_audio_path)
 
+    @modal.method()
+    def transcribe_object(self, audio_object_key: str) -> list[dict]:
+        """
+        Transcribe an audio file in the bucket, read straight from the mounted bucket
+        rather than sent over with the call and written to a temporary file.
+        """
+        print(f"🔄 Transcribing audio {audio_object_key} …")
+        return self._transcribe_path(str(pathlib.Path(BUCKET_DIR, audio_object_key)))
+
+    def _transcribe_path(self, audio_path: str) -> list[dict]:
+        # fp16 is whisper's default on GPU. verbose=False shows a progress bar instead
+        # of printing every decoded segment of hours of audio to the logs.
+        result = self.model.transcribe(audio_path, language="zh", fp16=True, verbose=False)
+        segments = [
+            {"start": segment["start"], "text": segment["text"]}
+            for segment in result["segments"]
+        ]
+
+        print(f"✅ Transcribed {len(segments)} segments")
+        return segments
+
 
 @app.function(
     timeout=100 * 60,  # 100 minutes
@@ -57,6 +87,7 @@ class Whisper:
     },
 )
 def transcribe_recordings():
+    import orjson
     import firefly_vcut.db as db
 
     with db.connection(os.getenv("DATABASE_URL")) as conn:
@@ -80,38 +111,30 @@ def transcribe_recordings():
             )
         else:
             if cache_path.exists():
-                with open(cache_path, "r") as f:
-                    segments = json.load(f)
+                # Left behind by an earlier run, already serialized
+                payload = cache_path.read_bytes()
                 print(f"✅ Transcribed recording {recording['title']} exists in cache")
             else:
                 # the ith audio is the ith page of the recording
                 # we merge all the pages into one transcript
-                segments = []
+                calls = []
                 for audio_key in recording["audioObjectKeys"]:
                     print(f"🔄 Transcribing page from {audio_key} …")
 
-                    audio_path = pathlib.Path(BUCKET_DIR, audio_key)
-                    with open(audio_path, "rb") as f:
-                        data = f.read()
-
-                    page_segments = modal.transcribe.remote(data, "mp4")
-                    segments.append(page_segments)
-
-                # Write the transcript to cache first.
-                print("🔄 Writing transcript to cache …")
-                cache_path.parent.mkdir(parents=True, exist_ok=True)
-                with open(cache_path, "w") as f:
-                    json.dump(segments, f)
-                cache_volume.commit()
-                print(
-                    f"✅ Transcribed recording {recording['title']} and wrote to cache"
-                )
-
-            # Then upload the transcript to the object store
-            object_path = pathlib.Path(BUCKET_DIR, transcript_key)
-            object_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(object_path, "w") as f:
-                json.dump(segments, f)
+                    # The Whisper containers mount the bucket and read the audio
+                    # themselves. Spawn rather than wait, so all the pages are submitted
+                    # up front.
+                    calls.append(modal.transcribe_object.spawn(audio_key))
+
+                segments = [call.get() for call in calls]
+                payload = orjson.dumps(segments)
+                print(f"✅ Transcribed all pages of {recording['title']}")
+
+            # The bucket is checked before transcribing, so writing the transcript
+            # there directly is as durable as staging it in the cache first.
+            print("🔄 Writing transcript to bucket …")
+            bucket_path.parent.mkdir(parents=True, exist_ok=True)
+            bucket_path.write_bytes(payload)
 
         with db.connection(os.getenv("DATABASE_URL")) as conn:
             db.recording.update_recording_transcript(
@@ -120,8 +143,9 @@ def transcribe_recordings():
         print(f"✅ Transcribed recording {recording['title']}")
 
         # Delete the cache
-        os.unlink(cache_path)
-        cache_volume.commit()
+        if cache_path.exists():
+            cache_path.unlink()
+            cache_volume.commit()
         # Delete the audio files
         for audio_key in recording["audioObjectKeys"]:
             audio_path = pathlib.Path(BUCKET_DIR, audio_key)
@@ -132,13 +156,11 @@ def transcript_key_from_recording(recording: dict) -> str:
     """
     Generate a transcript object key from a recording.
     """
-    import pytz
-
     bvid = recording["bvid"]
     mid = recording["mid"]
     pubdate = recording["pubdate"]
     # Extract year, month, day from pudate in tz Asia/Shanghai
-    pubdate = datetime.fromtimestamp(pubdate, tz=pytz.timezone("Asia/Shanghai"))
+    pubdate = datetime.fromtimestamp(pubdate, tz=SHANGHAI_TZ)
     year = pubdate.year
     month = pubdate.month
     day = pubdate.day
@@ -1,4 +1,6 @@
+import asyncio
 import os
+import aiohttp
 import modal
 import re
 
@@ -12,11 +14,15 @@ import firefly_vcut.bilibili as bilibili
 # Note that the order matters, see the example of the third pattern : )
 # Adjust this to your vtuber;s naming convention.
 SONG_VIDEO_PATTERNS = [
-    r"《(.*)》",  # e.g., '「我来不及道声不安，有点混乱有点缓慢」痛彻心扉翻唱《离开我的依赖》'
-    r"『(.*)』",  # e.g., '又想了一遍，在我忘记你之前”无与伦比翻唱版『轨迹』'
-    r"「(.*)」",  # e.g., '温柔女声翻唱“付出大半，仅是不起眼的「小半」”'
+    re.compile(r"《(.*)》"),  # e.g., '「我来不及道声不安，有点混乱有点缓慢」痛彻心扉翻唱《离开我的依赖》'
+    re.compile(r"『(.*)』"),  # e.g., '又想了一遍，在我忘记你之前”无与伦比翻唱版『轨迹』'
+    re.compile(r"「(.*)」"),  # e.g., '温柔女声翻唱“付出大半，仅是不起眼的「小半」”'
 ]
 
+# Number of vtubers whose uploaded videos are listed at the same time. Each listing
+# pauses between its pages, so this bounds the request rate bilibili sees.
+VTUBER_CONCURRENCY = 4
+
 
 @app.function(
     # Run every Monday, Thursday, and Saturday at 3:00AM Asia/Shanghai.
@@ -24,7 +30,7 @@ SONG_VIDEO_PATTERNS = [
     timeout=10 * 60,  # 10 minutes
     secrets=[secret],
 )
-def discover_new_song_videos():
+async def discover_new_song_videos():
     """
     Workflow to discover new song videos uploaded by vtubers and update the vtuber songs
     in the database to link to the new videos.
@@ -36,79 +42,117 @@ def discover_new_song_videos():
         # We will only search videos published after this anchor point.
         entries = db.song.list_latest_bvid_by_vtuber(conn)
         # Pre-populate a mapping from
-        # title -> vtuber_profile_id -> vtuber_song_id
+        # (title, vtuber_profile_id) -> vtuber_song_id
         # so we know which vtuber song to update given a new song title
         # we discovered
-        vtuber_songs = db.song.list_vtuber_songs_by_vtuber_profile_id(conn)
-        by_title = {}
-        for s in vtuber_songs:
-            if s["title"] not in by_title:
-                by_title[s["title"]] = {}
-            by_title[s["title"]][s["vtuber_profile_id"]] = s["vtuber_song_id"]
+        by_title = {
+            (s["title"], s["vtuber_profile_id"]): s["vtuber_song_id"]
+            for s in db.song.iter_vtuber_songs_by_vtuber_profile_id(conn)
+        }
+        # Only for telling unknown songs apart from songs of other vtubers in the logs
+        known_titles = {title for title, _ in by_title}
 
     sessdata = os.getenv("SESSDATA")
     wbi_key = bilibili.wbi.getWbiKeys(sessdata)
 
+    # Then for each vtuber, fetch new songs. The vtubers' listings are independent,
+    # run a few of them at once rather than one after another.
+    semaphore = asyncio.Semaphore(VTUBER_CONCURRENCY)
+
+    async def _find(entry: dict) -> list[dict]:
+        async with semaphore:
+            return await find_new_song_videos(
+                session, entry, by_title, known_titles, sessdata, wbi_key
+            )
+
+    async with bilibili.video_async.create_client_session() as session:
+        results = await asyncio.gather(*[_find(entry) for entry in entries])
+
     # List of update entries where each is a dictionary with the following keys:
     # - vtuber_song_id: The vtuber song ID.
     # - bvid: The Bilibili video ID.
     # - pubdate: The publication date of the video, unix epoch timestamp.
-    update_entries = []
-    # Then for each vtuber, fetch new songs
-    for entry in entries:
-        vtuber_profile_id = entry["vtuber_profile_id"]
-        mid = entry["mid"]
-        latest_video_pubdate = entry["latest_video_pubdate"]
-
-        videos = bilibili.video.list_user_videos(
-            mid,
-            sessdata,
-            wbi_key,
-            pubdate_after=latest_video_pubdate,
-        )
+    update_entries = [update_entry for result in results for update_entry in result]
 
-        print(f"Found {len(videos)} new song videos for vtuber {mid}")
+    if len(update_entries) == 0:
+        print("No new song videos found")
+        return
 
-        for video in videos:
-            title = extract_title_from_video_title(video["title"])
-            if title is None:
-                print(f"Vtuber {mid} uploaded a video with title that are unlikely to be a song: {video['title']}")
-                continue
+    with db.connection(os.getenv("DATABASE_URL")) as conn:
+        updated = db.song.update_bvid(conn, update_entries)
+        print(f"Updated {updated} new song videos")
 
-            if title not in by_title:
-                print(f"Vtuber {mid} uploaded an unknown song: {title}")
-                continue
 
-            if vtuber_profile_id not in by_title[title]:
+async def find_new_song_videos(
+    session: aiohttp.ClientSession,
+    entry: dict,
+    by_title: dict[tuple[str, int], int],
+    known_titles: set[str],
+    sessdata: str,
+    wbi_key: tuple[str, str],
+) -> list[dict]:
+    """
+    Find the song videos a vtuber uploaded after the latest one we know about.
+
+    Args:
+        session: The aiohttp session to issue bilibili requests with.
+        entry: An entry returned by db.song.list_latest_bvid_by_vtuber.
+        by_title: Mapping from (title, vtuber_profile_id) -> vtuber_song_id.
+        known_titles: The titles of all the songs in by_title.
+        sessdata: The sessdata of the login user.
+        wbi_key: The wbi key of the login user.
+
+    Returns:
+        A list of update entries to pass to db.song.update_bvid.
+    """
+    vtuber_profile_id = entry["vtuber_profile_id"]
+    mid = entry["mid"]
+    latest_video_pubdate = entry["latest_video_pubdate"]
+
+    update_entries = []
+    found = 0
+    # Match videos as their page comes in rather than after the whole listing.
+    async for video in bilibili.video_async.iter_user_videos(
+        session,
+        mid,
+        sessdata,
+        wbi_key,
+        pubdate_after=latest_video_pubdate,
+    ):
+        found += 1
+        title = extract_title_from_video_title(video["title"])
+        if title is None:
+            print(f"Vtuber {mid} uploaded a video with title that are unlikely to be a song: {video['title']}")
+            continue
+
+        vtuber_song_id = by_title.get((title, vtuber_profile_id))
+        if vtuber_song_id is None:
+            if title not in known_titles:
+                print(f"Vtuber {mid} uploaded an unknown song: {title}")
+            else:
                 print(
                     f"Vtuber {mid} uploaded a song that is not in their profile: {title}"
                 )
-                continue
-
-            vtuber_song_id = by_title[title][vtuber_profile_id]
+            continue
 
-            print(f"Vtuber {mid} uploaded a new song video: {title} ({video['bvid']})")
+        print(f"Vtuber {mid} uploaded a new song video: {title} ({video['bvid']})")
 
-            update_entries.append(
-                {
-                    "vtuber_song_id": vtuber_song_id,
-                    "bvid": video["bvid"],
-                    "pubdate": video["created"],
-                }
-            )
+        update_entries.append(
+            {
+                "vtuber_song_id": vtuber_song_id,
+                "bvid": video["bvid"],
+                "pubdate": video["created"],
+            }
+        )
 
-    if len(update_entries) == 0:
-        print("No new song videos found")
-        return
+    print(f"Found {found} new song videos for vtuber {mid}")
 
-    with db.connection(os.getenv("DATABASE_URL")) as conn:
-        updated = db.song.update_bvid(conn, update_entries)
-        print(f"Updated {updated} new song videos")
+    return update_entries
 
 
 def extract_title_from_video_title(title: str) -> str | None:
     for pattern in SONG_VIDEO_PATTERNS:
-        m = re.search(pattern, title)
+        m = pattern.search(title)
         if m:
             return m.group(1)
     return None
@@ -1,11 +1,14 @@
 import asyncio
-import time
+import math
+import random
 from typing import Callable, TypeVar, Any, Optional
-import requests
 import aiohttp
 
 T = TypeVar('T')
 
+# Status codes retried unless a config says otherwise
+_DEFAULT_RETRY_STATUS_CODES = frozenset({500, 502, 503, 504, 520, 521, 522, 523, 524})
+
 class RetryConfig:
     """Configuration for retry behavior with exponential backoff."""
     
@@ -21,68 +24,71 @@ class RetryConfig:
         self.initial_backoff = initial_backoff
         self.exponent = exponent
         self.max_backoff = max_backoff
-        self.retry_on_status_codes = retry_on_status_codes or [500, 502, 503, 504, 520, 521, 522, 523, 524]
+        # A set, it is checked against every response
+        self.retry_on_status_codes = (
+            frozenset(retry_on_status_codes) if retry_on_status_codes else _DEFAULT_RETRY_STATUS_CODES
+        )
 
-def should_retry_response(response: requests.Response, config: RetryConfig) -> bool:
-    """Check if a response should trigger a retry based on status code."""
-    return response.status_code in config.retry_on_status_codes
 
-def should_retry_aiohttp_response(response: aiohttp.ClientResponse, config: RetryConfig) -> bool:
-    """Check if an aiohttp response should trigger a retry based on status code."""
-    return response.status in config.retry_on_status_codes
+class NonRetryableError(Exception):
+    """Raised by a retried function for a failure retrying won't fix, it is raised right away."""
 
-def retry_with_backoff(
-    func: Callable[[], T],
-    config: RetryConfig,
-    *args,
-    **kwargs
-) -> T:
+
+class _Backoff:
     """
-    Retry a synchronous function with exponential backoff.
-    
-    Args:
-        func: The function to retry
-        config: Retry configuration
-        *args: Arguments to pass to the function
-        **kwargs: Keyword arguments to pass to the function
-        
-    Returns:
-        The result of the function call
-        
-    Raises:
-        Exception: The last exception that occurred after all retries
+    The retry state of one call to retry_with_backoff_async, deciding when and how
+    long to wait.
     """
-    last_exception = None
-    backoff = config.initial_backoff
-    
-    for attempt in range(config.max_retries + 1):
-        try:
-            result = func(*args, **kwargs)
-            
-            # If it's a requests.Response, check if we should retry based on status code
-            if isinstance(result, requests.Response) and should_retry_response(result, config):
-                if attempt < config.max_retries:
-                    print(f"HTTP {result.status_code} received, retrying in {backoff:.1f}s (attempt {attempt + 1}/{config.max_retries})")
-                    time.sleep(backoff)
-                    backoff = min(backoff * config.exponent, config.max_backoff or float('inf'))
-                    continue
-                else:
-                    print(f"Max retries ({config.max_retries}) reached for HTTP {result.status_code}")
-                    return result
-            
-            return result
-            
-        except Exception as e:
-            last_exception = e
-            if attempt < config.max_retries:
-                print(f"Exception occurred: {e}, retrying in {backoff:.1f}s (attempt {attempt + 1}/{config.max_retries})")
-                time.sleep(backoff)
-                backoff = min(backoff * config.exponent, config.max_backoff or float('inf'))
-            else:
-                print(f"Max retries ({config.max_retries}) reached, last exception: {e}")
-                raise last_exception
-    
-    raise last_exception
+
+    def __init__(self, config: RetryConfig):
+        self.config = config
+        self.attempt = 0
+        self.delay = config.initial_backoff
+        self.max_backoff = math.inf if config.max_backoff is None else config.max_backoff
+
+    def _advance(self) -> float:
+        self.attempt += 1
+        # Decorrelated jitter: grow the delay by up to the exponent from the last one,
+        # but pick it at random so that calls failing together don't retry in lockstep,
+        # the first retry included
+        self.delay = min(
+            random.uniform(self.config.initial_backoff, self.delay * self.config.exponent),
+            self.max_backoff,
+        )
+        return self.delay
+
+    def on_status(self, status: int) -> Optional[float]:
+        """
+        Decide what to do with a response of the given status code.
+
+        Returns:
+            The seconds to wait before retrying, or None to return the response
+        """
+        if status not in self.config.retry_on_status_codes:
+            return None
+        if self.attempt >= self.config.max_retries:
+            print(f"Max retries ({self.config.max_retries}) reached for HTTP {status}")
+            return None
+        delay = self._advance()
+        print(f"HTTP {status} received, retrying in {delay:.1f}s (attempt {self.attempt}/{self.config.max_retries})")
+        return delay
+
+    def on_exception(self, e: Exception) -> Optional[float]:
+        """
+        Decide what to do with an exception raised by the call.
+
+        Returns:
+            The seconds to wait before retrying, or None to raise the exception
+        """
+        if isinstance(e, NonRetryableError):
+            return None
+        if self.attempt >= self.config.max_retries:
+            print(f"Max retries ({self.config.max_retries}) reached, last exception: {e}")
+            return None
+        delay = self._advance()
+        print(f"Exception occurred: {e}, retrying in {delay:.1f}s (attempt {self.attempt}/{self.config.max_retries})")
+        return delay
+
 
 async def retry_with_backoff_async(
     func: Callable[[], Any],
@@ -100,39 +106,26 @@ async def retry_with_backoff_async(
         **kwargs: Keyword arguments to pass to the function
         
     Returns:
-        The result of the function call
+        The result of the function call, an aiohttp.ClientResponse with a retryable
+        status code is retried too
         
     Raises:
         Exception: The last exception that occurred after all retries
     """
-    last_exception = None
-    backoff = config.initial_backoff
-    
-    for attempt in range(config.max_retries + 1):
+    backoff = _Backoff(config)
+    while True:
         try:
             result = await func(*args, **kwargs)
-            
-            # If it's an aiohttp.ClientResponse, check if we should retry based on status code
-            if isinstance(result, aiohttp.ClientResponse) and should_retry_aiohttp_response(result, config):
-                if attempt < config.max_retries:
-                    print(f"HTTP {result.status} received, retrying in {backoff:.1f}s (attempt {attempt + 1}/{config.max_retries})")
-                    await asyncio.sleep(backoff)
-                    backoff = min(backoff * config.exponent, config.max_backoff or float('inf'))
-                    continue
-                else:
-                    print(f"Max retries ({config.max_retries}) reached for HTTP {result.status}")
-                    return result
-            
-            return result
-            
         except Exception as e:
-            last_exception = e
-            if attempt < config.max_retries:
-                print(f"Exception occurred: {e}, retrying in {backoff:.1f}s (attempt {attempt + 1}/{config.max_retries})")
-                await asyncio.sleep(backoff)
-                backoff = min(backoff * config.exponent, config.max_backoff or float('inf'))
-            else:
-                print(f"Max retries ({config.max_retries}) reached, last exception: {e}")
-                raise last_exception
-    
-    raise last_exception
\ No newline at end of file
+            delay = backoff.on_exception(e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+
+        if isinstance(result, aiohttp.ClientResponse):
+            delay = backoff.on_status(result.status)
+            if delay is not None:
+                await asyncio.sleep(delay)
+                continue
+        return result
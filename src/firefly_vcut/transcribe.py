@@ -4,6 +4,7 @@ import os
 import json
 import whisper
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from .types import Archive
 
@@ -38,6 +39,94 @@ def download_audio(recording: Archive):
         )
         cmd.check_returncode()
 
+def download(recording: Archive) -> list[str]:
+    """
+    Download the audio files of a recording.
+
+    Args:
+        recording: The recording information
+
+    Returns:
+        The downloaded audio files of the recording, one per page in page order
+    """
+
+    # 使用 BBDown 下载录播音频
+    # https://github.com/nilaoda/BBDown
+    download_audio(recording)
+
+    # 获取录播文件，按照分p排序
+    # scandir knows which entries are files without a stat per entry
+    with os.scandir(".") as entries:
+        audio_files = sorted(
+            entry.name
+            for entry in entries
+            if entry.name.startswith(recording.bvid) and entry.is_file()
+        )
+
+    logger.info(f"Downloaded {len(audio_files)} audio files for {recording.bvid}")
+
+    return audio_files
+
+def transcribe(audio_files: list[str], transcription_file: str, model: whisper.Whisper) -> float:
+    """
+    Transcribe the downloaded audio files of a recording. Write the segments to the given file
+    and remove the audio files.
+
+    Args:
+        audio_files: The audio files of the recording, see download
+        transcription_file: The file to write the transcription to
+        model: The model to use for transcription
+
+    Returns:
+        GPU time spent processing the recording in seconds
+
+    Side Effects:
+        - Write the transcription of the recording to the given file, see download_and_transcribe
+        - Remove the audio files
+    """
+
+    total_gpu_time = 0
+
+    # segments: An array of segment array for each page
+    segments = []
+    # Decode the next page with ffmpeg on the CPU while the GPU transcribes the current one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        decoding = [executor.submit(whisper.load_audio, audio_file) for audio_file in audio_files[:1]]
+        for i, audio_file in enumerate(audio_files):
+            audio = decoding.pop().result()
+            if i + 1 < len(audio_files):
+                decoding.append(executor.submit(whisper.load_audio, audio_files[i + 1]))
+
+            logger.info(f"Transcribing {audio_file}...")
+
+            start_time = time.time()
+            result = model.transcribe(audio, language="zh", verbose=False)
+            end_time = time.time()
+            total_gpu_time += end_time - start_time
+            del audio
+
+            # 我们只需要 start 和 text，省一点存储空间
+            segments.append([
+                {
+                    "start": segment["start"],
+                    "text": segment["text"]
+                }
+                for segment in result["segments"]
+            ])
+
+            # Free the disk space of the page as soon as it's transcribed
+            try:
+                os.remove(audio_file)
+            except FileNotFoundError:
+                pass
+
+    # Serialize in one go rather than json.dump's many small writes, and keep the
+    # Chinese text as UTF-8 instead of escaping every character as \uXXXX
+    with open(transcription_file, "wb") as f:
+        f.write(json.dumps(segments, ensure_ascii=False).encode())
+    
+    return total_gpu_time
+
 def download_and_transcribe(recording: Archive, transcription_file: str, model: whisper.Whisper) -> float:
     """
     Download the audio files of a recording and transcribe them. Write the segments to the given file
@@ -65,45 +154,5 @@ def download_and_transcribe(recording: Archive, transcription_file: str, model:
 
     logger.info(f"Downloading audio files for {recording.bvid}...")
 
-    # 使用 BBDown 下载录播音频
-    # https://github.com/nilaoda/BBDown
-    download_audio(recording)
-
-    # 获取录播文件
-    # segments: An array of segment array for each page
-    audio_files = []
-    for file in os.listdir("."):
-        if file.startswith(recording.bvid):
-            audio_files.append(file)
-    # 按照分p排序
-    audio_files.sort()
-
-    logger.info(f"Downloaded {len(audio_files)} audio files for {recording.bvid}")
-
-    total_gpu_time = 0
-
-    segments = []
-    for audio_file in audio_files:
-        logger.info(f"Transcribing {audio_file}...")
-
-        start_time = time.time()
-        result = model.transcribe(audio_file, language="zh", verbose=True)
-        end_time = time.time()
-        total_gpu_time += end_time - start_time
-
-        # 我们只需要 start 和 text，省一点存储空间
-        segments.append([
-            {
-                "start": segment["start"],
-                "text": segment["text"]
-            }
-            for segment in result["segments"]
-        ])
-
-    with open(transcription_file, "w") as f:
-        json.dump(segments, f)
-    
-    for audio_file in audio_files:
-        os.remove(audio_file)
-    
-    return total_gpu_time
\ No newline at end of file
+    audio_files = download(recording)
+    return transcribe(audio_files, transcription_file, model)
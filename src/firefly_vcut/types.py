@@ -1,13 +1,15 @@
 from dataclasses import dataclass
 
-@dataclass
+@dataclass(slots=True)
 class VtuberSong:
     song_id: int
     vtuber_song_id: int
     title: str
     lyrics_fragment: str
 
-@dataclass
+# Archives are materialized by the thousand from series pages, slots make construction
+# cheaper and the instances smaller.
+@dataclass(slots=True)
 class Archive:
     id: int | None
     bvid: str
@@ -16,7 +18,7 @@ class Archive:
     cover: str
     duration: int
 
-@dataclass
+@dataclass(slots=True)
 class SongOccurrence:
     # song_id is the id of the song in the database
     song_id: int
@@ -29,7 +31,7 @@ class SongOccurrence:
     # page is the page of the song in the archive
     page: int
 
-@dataclass
+@dataclass(slots=True)
 class Series:
     series_id: int
     name: str
\ No newline at end of file